@@ -1,18 +1,158 @@
+import os
+import time
+import threading
+import multiprocessing
 import jenkins_slack_notifications
 import github_slack_notifications
+import http_client
+import slack_queue
 from apscheduler.schedulers.blocking import BlockingScheduler
 
-def jenkins():
-    jenkins_slack_notifications.main()
+# global constants:
+GITHUB_HOST = 'api.github.com'
+# Fraction of the GitHub rate limit to leave unused, for rtm.py and people:
+RATE_LIMIT_RESERVE = 0.1
+# Set JOB_PROCESSES=1 to run each job in its own worker process instead of a
+# thread of this one. State the jobs share is kept in state_store either way.
+JOB_PROCESSES = os.environ.get('JOB_PROCESSES') == '1'
 
-def github():
-    github_slack_notifications.main()
+# Run a job's function and return its result, the number of GitHub requests it
+# made, and the GitHub rate limit after it ran. Worker processes have their own
+# http_client, so this is what they send back.
+def call(function):
+    github_requests = http_client.totals.get(GITHUB_HOST, 0)
+    activity = function()
+    return (
+        activity,
+        http_client.totals.get(GITHUB_HOST, 0) - github_requests,
+        http_client.rate_limits.get(GITHUB_HOST)
+    )
+
+# A job that runs on an interval that adapts to activity: it halves after a run
+# that found something new and grows by half after a run that didn't, within
+# [min_interval, max_interval]. Jobs that use the GitHub API also stretch their
+# interval so that their share of the remaining rate limit lasts until it
+# resets, but never past max_stretch, the longest gap between runs that the job
+# can look back over without missing anything. A run that's still going when
+# the next one is due makes the next one get skipped, not queued.
+class AdaptiveJob:
+
+    def __init__(self, name, function, interval, min_interval, max_interval,
+        max_stretch):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_stretch = max_stretch
+        self.lock = threading.Lock()
+        self.due = time.time() + interval
+        # The worker process this job runs in, if JOB_PROCESSES is set:
+        self.pool = None
+
+    # Start a worker process for this job. Processes are spawned, not forked,
+    # so they don't inherit this process's database connections or threads,
+    # and they're kept between runs so module state like watermarks and
+    # indexes stays warm.
+    def start_process(self):
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(processes=1)
+
+    def run(self):
+        if not self.lock.acquire(blocking=False):
+            print(self.name + ' is still running; skipping this run.')
+            self.update_due()
+            return
+        try:
+            start = time.time()
+            late = start - self.due
+            if self.pool:
+                result = self.pool.apply(call, (self.function,))
+            else:
+                result = call(self.function)
+            duration = time.time() - start
+            self.adjust(*result)
+            print(
+                '{} took {:.1f}s, started {:.1f}s late, next in {:.0f}s'.format(
+                    self.name,
+                    duration,
+                    late,
+                    self.interval
+                )
+            )
+        finally:
+            self.update_due()
+            self.lock.release()
+
+    # APScheduler schedules each run from the scheduled time of the one before,
+    # not from when it finished, so lateness is measured from the time the
+    # scheduler has set for the next run:
+    def update_due(self):
+        job = SCHEDULER.get_job(self.name)
+        if job and job.next_run_time:
+            self.due = job.next_run_time.timestamp()
+
+    def adjust(self, activity, github_requests, rate_limit):
+        if activity:
+            interval = self.interval / 2
+        else:
+            interval = self.interval * 1.5
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        if github_requests and rate_limit:
+            remaining, reset = rate_limit
+            # The jobs share the rate limit, so each gets an equal part of it:
+            budget = remaining * (1 - RATE_LIMIT_RESERVE) / len(JOBS)
+            runs_left = max(budget / github_requests, 1)
+            interval = max(interval, (reset - time.time()) / runs_left)
+            interval = min(interval, self.max_stretch)
+        if interval != self.interval:
+            self.interval = interval
+            SCHEDULER.reschedule_job(
+                self.name,
+                trigger='interval',
+                seconds=interval
+            )
+
+JOBS = [
+    AdaptiveJob(
+        'jenkins',
+        jenkins_slack_notifications.main,
+        10,
+        5,
+        60,
+        # Half of MAX_AGE, which is in milliseconds, so that every build is
+        # seen by a run:
+        jenkins_slack_notifications.MAX_AGE / 2000
+    ),
+    AdaptiveJob(
+        'github',
+        github_slack_notifications.main,
+        60,
+        30,
+        300,
+        github_slack_notifications.MAX_LOOKBACK
+    )
+]
+SCHEDULER = BlockingScheduler()
 
 if __name__ == '__main__':
-    scheduler = BlockingScheduler()
-    scheduler.add_job(jenkins, 'interval', seconds=10)
-    scheduler.add_job(github, 'interval', seconds=60)
+    # Start sending queued Slack messages, including any left over from
+    # before a restart:
+    slack_queue.start()
+    for job in JOBS:
+        if JOB_PROCESSES:
+            job.start_process()
+        SCHEDULER.add_job(
+            job.run,
+            'interval',
+            seconds=job.interval,
+            id=job.name,
+            coalesce=True
+        )
+    # Log request and byte counts per host:
+    SCHEDULER.add_job(http_client.report, 'interval', minutes=10)
+    SCHEDULER.add_job(slack_queue.report, 'interval', minutes=1)
     try:
-        scheduler.start()
+        SCHEDULER.start()
     except (KeyboardInterrupt, SystemExit):
         pass
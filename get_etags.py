@@ -2,14 +2,17 @@ from json import load
 from json import dump
 from json.decoder import JSONDecodeError
 
-def main():
+# Also used for other small JSON state files, such as cursors:
+def main(filename='etags'):
     output = {}
     try:
-        with open('etags', 'r') as infile:
+        with open(filename, 'r') as infile:
             output = load(infile)
+    except FileNotFoundError:
+        pass
     except JSONDecodeError:
-        print('JSON decoder error in etags file; clearing file.')
-        with open('etags', 'w') as outfile:
+        print('JSON decoder error in ' + filename + ' file; clearing file.')
+        with open(filename, 'w') as outfile:
             dump(output, outfile)
     return output
 
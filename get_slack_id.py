@@ -1,32 +1,108 @@
 import csv
+import io
 import os
-import requests
-import json
-import re
-import get_etags
+import tempfile
+import http_client
+import response_cache
 from base64 import b64decode
 
-def check_match(match, mapping):
-    for user in mapping:
-        if match in user.values():
-            return user
+# global variables:
+# Index of every value in mapping.csv (GitHub login, email, Slack name, etc.)
+# and every normalized real name, pointing to the row it came from:
+mapping_index = {}
+# ETag of the mapping.csv response mapping_index was built from:
+mapping_etag = None
 
-def user_in_mapping(csvfile, matches):
-    mapping = csv.DictReader(csvfile, lineterminator='\n')
-    output = {}
+# Lowercase a name and collapse its whitespace so that 'Jane  Doe' and
+# 'jane doe' resolve to the same user:
+def normalize(name):
+    return ' '.join(name.lower().split())
+
+# Build the index from mapping.csv. When the same value appears in more than
+# one row, the first row wins.
+def index_mapping(csvfile):
+    index = {}
+    for row in csv.DictReader(csvfile, lineterminator='\n'):
+        for value in row.values():
+            if value:
+                index.setdefault(value, row)
+        if row.get('real_name'):
+            index.setdefault(normalize(row['real_name']), row)
+    return index
+
+def lookup(matches):
     for match in matches:
-        csvfile.seek(0,0)
-        output = check_match(match, mapping)
-        if match and output:
-            return output
+        if match and match in mapping_index:
+            return mapping_index[match]
+    for match in matches:
+        if match and normalize(match) in mapping_index:
+            return mapping_index[normalize(match)]
 
 def string_to_bool(string):
     if string == 'True':
         return True
 
+# The new mapping is written to a temporary file and renamed over mapping.csv,
+# so that other processes never read a partly written file:
 def update_mapping(downloaded_data):
-    with open('mapping.csv', 'w', newline='') as csvfile:
-        csvfile.write(b64decode(bytearray(downloaded_data, 'utf-8')).decode())
+    # A temporary file of its own, since threads of one process may be writing
+    # the mapping at the same time:
+    descriptor, filename = tempfile.mkstemp(dir='.')
+    with open(descriptor, 'w', newline='') as csvfile:
+        csvfile.write(decode(downloaded_data))
+    os.replace(filename, 'mapping.csv')
+
+def decode(downloaded_data):
+    return b64decode(bytearray(downloaded_data, 'utf-8')).decode()
+
+# Revalidate mapping.csv against GitHub and rebuild the index if it changed, or
+# if the index (perhaps restored from a snapshot) was built from some other
+# version of it. This should be called once per cycle; GetSlackID only reads
+# the index.
+def refresh_mapping():
+    global mapping_index, mapping_etag
+    mapping_url = 'https://api.github.com/'\
+        'repos/'\
+        'TeachersPayTeachers/'\
+        'slack-mapping/'\
+        'contents/'\
+        'mapping.csv'
+    mapping = response_cache.get(http_client.GITHUB, mapping_url)
+    # If GitHub is failing, fall back to the last downloaded mapping.csv:
+    if mapping.status_code >= 300:
+        if not mapping_index:
+            with open('mapping.csv', 'r', newline='') as csvfile:
+                mapping_index = index_mapping(csvfile)
+        return
+    if mapping.modified:
+        update_mapping(mapping.json()['content'])
+    etag = mapping.headers.get('Etag')
+    if mapping.modified or not mapping_index or etag != mapping_etag:
+        mapping_index = index_mapping(
+            io.StringIO(decode(mapping.json()['content']), newline='')
+        )
+        mapping_etag = etag
+
+# Return the index as JSON-compatible values for snapshot. Rows are listed once
+# and the index points to their position:
+def dump_state():
+    rows = []
+    positions = {}
+    index = {}
+    for value, row in mapping_index.items():
+        if id(row) not in positions:
+            positions[id(row)] = len(rows)
+            rows.append(row)
+        index[value] = positions[id(row)]
+    return {'etag': mapping_etag, 'rows': rows, 'index': index}
+
+def load_state(state):
+    global mapping_index, mapping_etag
+    mapping_index = dict(
+        (value, state['rows'][position])
+        for value, position in state['index'].items()
+    )
+    mapping_etag = state['etag']
 
 class GetSlackID:
 
@@ -34,26 +110,9 @@ class GetSlackID:
         self.exists = False
         matches = [user, email, author]
         ignored_users = ['noreply', 'tptdeploybot', 'Darkseid-Apokolips']
-        etag = ''
-        etags = get_etags.main()
-        if 'mapping' in etags.keys():
-            etag = '"' + re.findall('\w\w+', etags['mapping'])[0] + '"'
-        token_header = 'token ' + os.environ['GITHUB_REPO_TOKEN']
-        headers = {'Authorization': token_header, 'If-None-Match': etag}
-        mapping_url = 'https://api.github.com/'\
-            'repos/'\
-            'TeachersPayTeachers/'\
-            'slack-mapping/'\
-            'contents/'\
-            'mapping.csv'
-        mapping = requests.get(mapping_url, headers=headers)
-        etags['mapping'] = mapping.headers['Etag']
-        with open('etags', 'w') as outfile:
-            json.dump(etags, outfile)
-        if mapping.status_code < 304:
-            update_mapping(mapping.json()['content'])
-        with open('mapping.csv', 'r', newline='') as csvfile:
-            output = user_in_mapping(csvfile, matches)
+        if not mapping_index:
+            refresh_mapping()
+        output = lookup(matches)
         if output:
             self.slack_id = output['slack_id']
             self.slack_name = output['slack_name']
@@ -1,56 +1,155 @@
 import yaml
 import re
-import json
 import os
-import requests
 import datetime
+import time
+import threading
 import get_etags
+import http_client
+import response_cache
+import slack_queue
+import snapshot
+import user_profiles
 import track_notifications
+import get_slack_id
 from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
 from get_slack_id import GetSlackID
 
 # global constants:
 MAX_AGE = 100 #seconds
+# Most seconds a polling run looks back past MAX_AGE for items it missed
+# between runs. GitHub's rate limit resets every hour, so clock.py never
+# stretches the interval past this.
+MAX_LOOKBACK = 60 * 60
 GITHUB_API = 'https://api.github.com/repos/TeachersPayTeachers/'
-TOKEN_HEADER = {'Authorization': 'token ' + os.environ['GITHUB_REPO_TOKEN']}
+# Number of repos to fetch at once. Set to 1 to fetch repos one at a time.
+GITHUB_WORKERS = int(os.environ.get('GITHUB_WORKERS', 8))
+# Set GITHUB_EVENTS=1 to read the org events feed instead of polling each repo:
+GITHUB_EVENTS = os.environ.get('GITHUB_EVENTS') == '1'
+EVENTS_URL = 'https://api.github.com/orgs/TeachersPayTeachers/events'
+REPOS_URL = 'https://api.github.com/orgs/TeachersPayTeachers/repos'
+# Number of streams (commits, pulls and comments) to run at once. Set to 1 to
+# run them one after another.
+GITHUB_STREAM_WORKERS = int(os.environ.get('GITHUB_STREAM_WORKERS', 3))
+SUBSCRIPTIONS_LOCK = threading.Lock()
 
 # global variables:
 current_time = datetime.datetime(datetime.MINYEAR, 1, 1)
-etags = {}
-
-# Check the subscriptions file to see which Slack channels are subscribed to
-# this user:
-def notifications_on(command, user):
-    global etags, GITHUB_API, TOKEN_HEADER
+# Dict of '<repo>-<stream>' to the newest item seen in that stream, of the form
+# {'id': number, 'time': timestamp}:
+cursors = {}
+# Dict of command to a dict of user to the channels subscribed to that user:
+subscription_index = {}
+# Dict of command to the ETag of the subscriptions file its index was built
+# from:
+subscription_etags = {}
+# Commands whose subscriptions file has been revalidated this cycle:
+refreshed = set()
+# Unix time before which GitHub has asked us not to poll the events feed again:
+next_poll = 0
+# Seconds this cycle looks back for new items: MAX_AGE for webhook events, and
+# for polling runs, also the time since the last polling run started:
+lookback = MAX_AGE
+# Unix time the last polling run started:
+last_poll = None
+
+# Revalidate a subscriptions file against GitHub and, if it changed or its
+# index was built from some other version of it, rebuild its index of user to
+# subscribed channels:
+def refresh_subscriptions(command):
+    global subscription_index, subscription_etags, GITHUB_API
     filename = command + '_subscriptions.yaml'
-    etag = ''
-    if command in etags.keys():
-        etag = '"' + re.findall('\w\w+', etags[command])[0] + '"'
-    headers = {**TOKEN_HEADER, **{'If-None-Match': etag}}
     url = GITHUB_API + 'slack-mapping/contents/' + filename
-    subscriptions = requests.get(url, headers=headers)
-    etags[command] = subscriptions.headers['Etag']
-    if subscriptions.status_code < 304:
+    subscriptions = response_cache.get(http_client.GITHUB, url)
+    etag = subscriptions.headers.get('Etag')
+    if subscriptions.status_code >= 300:
+        # If GitHub is failing, fall back to the last downloaded file:
+        if command in subscription_index:
+            return
+        with open(filename, 'r') as infile:
+            content = infile.read()
+    else:
         b64encoded = bytearray(subscriptions.json()['content'], 'utf-8')
-        with open(filename, 'w') as outfile:
-            outfile.write(b64decode(b64encoded).decode())
-    channel_subscriptions = yaml.safe_load(open(filename, 'r'))
-    notifications_on = []
+        content = b64decode(b64encoded).decode()
+        if subscriptions.modified:
+            with open(filename, 'w') as outfile:
+                outfile.write(content)
+        elif (command in subscription_index and
+            etag == subscription_etags.get(command)):
+            return
+    channel_subscriptions = yaml.safe_load(content)
+    index = {}
     for channel in channel_subscriptions:
-        if user in channel_subscriptions[channel]:
-            notifications_on.append(channel)
-    return notifications_on
+        for subscribed_user in channel_subscriptions[channel]:
+            index.setdefault(subscribed_user, []).append(channel)
+    subscription_index[command] = index
+    subscription_etags[command] = etag
 
-# Send a message to a list of Slack channels:
+# Return the Slack channels subscribed to this user. Each subscriptions file is
+# revalidated at most once per cycle:
+def notifications_on(command, user):
+    global subscription_index, refreshed
+    with SUBSCRIPTIONS_LOCK:
+        if command not in refreshed:
+            refresh_subscriptions(command)
+            refreshed.add(command)
+    return list(subscription_index[command].get(user, []))
+
+# Queue a message for a list of Slack channels:
 def slack(message, channels):
     for channel in channels:
-        params = {
-            'token': os.environ['BUILD_BOT_API_TOKEN'],
+        slack_queue.enqueue({
             'channel': channel,
             'text': message,
             'as_user': True
-        }
-        requests.get('https://slack.com/api/chat.postMessage', params=params)
+        })
+
+# Get new events from the org events feed, newest first. GitHub keeps the last
+# 300 events, so pages are followed back to the cursor or until they run out.
+def get_events():
+    global cursors, next_poll, EVENTS_URL
+    if time.time() < next_poll:
+        return []
+    cursor = cursors.get('org-events')
+    response = response_cache.get(
+        http_client.GITHUB,
+        EVENTS_URL,
+        params={'per_page': 100}
+    )
+    next_poll = time.time() + int(response.headers.get('X-Poll-Interval', 0))
+    if not response.modified:
+        return []
+    events = []
+    while True:
+        page = response.json()
+        new_events = [e for e in page if not cursor or int(e['id']) > cursor]
+        events += new_events
+        if (not page or len(new_events) < len(page) or not
+            ('link' in response.headers and 'next' in response.headers['link'])):
+            break
+        # Regex to parse URL from header:
+        url = re.findall('<(\S+)>; rel="next"', response.headers['link'])[0]
+        response = http_client.GITHUB.get(url)
+        if response.status_code >= 300:
+            break
+    if events:
+        cursors['org-events'] = max(int(e['id']) for e in events)
+    return events
+
+def get_repos(repos_url):
+    tpt_repos = http_client.GITHUB.get(repos_url)
+    # If GitHub is failing, skip polling repos this cycle:
+    if tpt_repos.status_code >= 300:
+        print('Error listing repos: ' + str(tpt_repos.status_code))
+        return []
+    # If there are more pages of repos, get them recursively:
+    headers = tpt_repos.headers
+    if 'link' in headers.keys() and 'next' in headers['link']:
+        # Regex to parse URL from header:
+        url = re.findall('(?<=<)\S+(?=>)', headers['link'])[0]
+        return tpt_repos.json() + get_repos(url)
+    return tpt_repos.json()
 
 # Attempt to map data in a notification (commit, pull, or comment) to a Slack
 # user:
@@ -66,29 +165,134 @@ def user_from_notification(notification):
 class Notify:
 
     def __init__(self):
-        global TOKEN_HEADER, MAX_AGE, current_time
+        global lookback, current_time
         timestamp_format = '%a, %d %b %Y %H:%M:%S GMT'
-        max_age = datetime.timedelta(seconds=MAX_AGE)
+        max_age = datetime.timedelta(seconds=lookback)
         time_since = (current_time - max_age).strftime(timestamp_format)
-        self.header = {**TOKEN_HEADER, **{'If-Modified-Since': time_since}}
-
-    # Get JSON data from the Github API:
-    def get_data(self):
-        data = requests.get(self.url, headers=self.header)
-        if data.status_code < 304:
-            return data.json()
+        self.header = {'If-Modified-Since': time_since}
+        # When set, get_data reads items from these org events instead of
+        # polling the API:
+        self.events = None
+        # Cursors moved by this cycle, added to the global cursors by run so
+        # that streams running at once don't share a dict:
+        self.cursors = {}
+
+    # Query parameters for the first page of a stream. Results are sorted
+    # newest first, and where the API allows it, limited to items since the
+    # cursor (or since lookback seconds ago if there's no cursor yet).
+    def get_params(self, cursor):
+        global lookback, current_time
+        timestamp_format = '%Y-%m-%dT%H:%M:%SZ'
+        if cursor:
+            since = cursor['time']
         else:
-            return []
+            max_age = datetime.timedelta(seconds=lookback)
+            since = (current_time - max_age).strftime(timestamp_format)
+        return {'since': since, 'per_page': 100}
+
+    # Return True if an item is newer than the stream's cursor:
+    def is_new(self, data, cursor):
+        return not cursor or self.get_number(data) > cursor['id']
+
+    # Return True if there's no need to fetch the page after this one:
+    def reached_cursor(self, page, params, cursor):
+        if not page:
+            return True
+        if cursor:
+            return not all(self.is_new(data, cursor) for data in page)
+        # Without a cursor, only follow pages limited by a since parameter:
+        return 'since' not in params
+
+    # Fetch one repo's new items, following pagination back to the cursor. The
+    # first page is revalidated through response_cache; if it hasn't changed,
+    # there's nothing new. This runs in a worker thread, so it must not change
+    # cursors; they're returned and added by merge instead.
+    def fetch_repo(self, repo):
+        global cursors
+        stream = self.get_stream(repo['name'])
+        cursor = cursors.get(stream)
+        params = self.get_params(cursor)
+        response = response_cache.get(
+            http_client.GITHUB,
+            self.get_url(repo['name']),
+            params=params,
+            headers=self.header
+        )
+        if not response.modified:
+            return ([], stream, cursor or self.first_cursor(params))
+        page = response.json()
+        data = [d for d in page if self.is_new(d, cursor)]
+        while ('link' in response.headers and
+            'next' in response.headers['link'] and not
+            self.reached_cursor(page, params, cursor)):
+            # Regex to parse URL from header:
+            url = re.findall('<(\S+)>; rel="next"', response.headers['link'])[0]
+            response = http_client.GITHUB.get(url)
+            if response.status_code >= 300:
+                # Don't move the cursor past items that weren't fetched:
+                return (data, stream, cursor)
+            page = response.json()
+            data += [d for d in page if self.is_new(d, cursor)]
+        return (
+            data,
+            stream,
+            self.new_cursor(data, cursor) or self.first_cursor(params)
+        )
 
-    # Process JSON data from the Github API:
-    def set_data(self):
+    # Return a cursor at the since time of a stream's first poll, for streams
+    # with nothing to point to yet. Otherwise since would move every cycle, so
+    # idle streams would never be answered from the response cache.
+    def first_cursor(self, params):
+        if 'since' in params:
+            return {'id': 0, 'time': params['since']}
+
+    # Return a cursor pointing to the newest item in data:
+    def new_cursor(self, data, cursor):
+        if not data:
+            return cursor
+        # max returns the first of several items with the same time, which is
+        # the newest since results are sorted newest first:
+        newest = max(data, key=self.get_time)
+        return {'id': self.get_number(newest), 'time': self.get_time(newest)}
+
+    # Yield the items from the results of fetch_repo, in order, as each
+    # repo's results arrive:
+    def merge(self, new_repos):
+        for new_repo in new_repos:
+            if new_repo[2]:
+                self.cursors[new_repo[1]] = new_repo[2]
+            for data in new_repo[0]:
+                yield data
+
+    # Yield JSON data from the Github API:
+    def get_data(self):
+        if self.events is not None:
+            return self.from_events()
+        return self.merge([self.fetch_repo({'name': self.repo})])
+
+    # Yield the items in self.events that this class notifies about, in the
+    # same format as the API responses polled by get_data:
+    def from_events(self):
+        for event in self.events:
+            for data in self.from_event(event):
+                yield data
+
+    # Yield the items in data from the last lookback seconds, each with its
+    # time as a Python datetime object:
+    def recent(self, data):
+        global lookback, current_time
         timestamp_format = '%Y-%m-%dT%H:%M:%SZ'
-        data = self.get_data()
-        self.notifications = []
         for d in data:
-            # Return a Python datetime object from a JSON timestamp:
             time = datetime.datetime.strptime(self.get_time(d), timestamp_format)
-            self.notifications.append(self.new_notification(d, time))
+            if (current_time - time).total_seconds() < lookback:
+                yield (d, time)
+
+    # Yield a notification for each recent item we haven't already sent a
+    # Slack message for. Items are fetched lazily, so the first notification
+    # is yielded before later repos have been fetched.
+    def get_notifications(self):
+        for d, time in self.recent(self.get_data()):
+            notification = self.new_notification(d)
             self.user_data = {}
             track_notifications.track(
                 self.get_number(d),
@@ -96,17 +300,16 @@ class Notify:
                 time.timestamp() * 1000,
                 self.filename
             )
-
-    def new_notification(self, data, time):
-        global MAX_AGE, current_time
-        # If a commit, pull, or comment isn't too old and we haven't already
-        # sent a Slack message for it, return data necessary to create a
-        # notification:
-        if ((current_time - time).total_seconds() < MAX_AGE and not
-            track_notifications.already_notified(
-                self.get_number(data),
-                self.filename
-            )):
+            if notification:
+                yield notification
+
+    def new_notification(self, data):
+        # If we haven't already sent a Slack message for a commit, pull, or
+        # comment, return data necessary to create a notification:
+        if not track_notifications.already_notified(
+            self.get_number(data),
+            self.filename
+        ):
             return {
                 'author': self.get_author(data),
                 'email': self.get_email(data),
@@ -120,10 +323,15 @@ class Notify:
     def get_body(self, data):
         pass
 
+    # Send each new notification as soon as it's found. Return the number of
+    # new items.
     def send_notifications(self):
-        for notification in self.notifications:
+        new_items = 0
+        for notification in self.get_notifications():
             user = user_from_notification(notification)
             self.notification_for_user(notification, user)
+            new_items += 1
+        return new_items
 
     def notification_for_user(self, notification, user):
         if user and user.exists:
@@ -134,11 +342,48 @@ class Notify:
 class Commits(Notify):
 
     def __init__(self):
-        global GITHUB_API
         super().__init__()
-        self.url = GITHUB_API + 'tpt/commits'
+        self.repo = 'tpt'
         self.filename = 'shas'
 
+    def get_url(self, repo):
+        global GITHUB_API
+        return GITHUB_API + repo + '/commits'
+
+    def get_stream(self, repo):
+        return repo + '-commits'
+
+    # Pushes to master of tpt. Push events don't include the commit date or a
+    # link to the commit, so the push time is used instead:
+    def from_event(self, event):
+        if (event['type'] != 'PushEvent' or
+            event['repo']['name'] != 'TeachersPayTeachers/' + self.repo or
+            event['payload']['ref'] != 'refs/heads/master'):
+            return []
+        return [{
+            'sha': commit['sha'],
+            'commit': {
+                'author': {
+                    'name': commit['author']['name'],
+                    'email': commit['author']['email'],
+                    'date': event['created_at']
+                }
+            },
+            'author': {'login': event['actor']['login']},
+            'html_url': 'https://github.com/{}/commit/{}'.format(
+                event['repo']['name'],
+                commit['sha']
+            )
+        } for commit in event['payload']['commits']]
+
+    # Commit shas aren't ordered, so a commit is new if it isn't the cursor's
+    # commit and isn't older than it:
+    def is_new(self, commit, cursor):
+        return not cursor or (
+            self.get_number(commit) != cursor['id'] and
+            self.get_time(commit) >= cursor['time']
+        )
+
     def get_time(self, commit):
         return commit['commit']['author']['date']
 
@@ -170,58 +415,44 @@ class Pulls(Notify):
         super().__init__()
         self.filename = 'pull_numbers'
         self.user_data = {}
+        # The org's repos, shared with other streams. Listed by get_data if
+        # not set.
+        self.repos = None
 
     def get_url(self, repo):
         global GITHUB_API
         return GITHUB_API + repo + '/pulls'
 
-    def get_new_repo(self, url, headers):
-        data = requests.get(url, headers=headers)
-        if data.status_code < 304:
-            return (data.json(), data.headers['Etag'])
-        else:
-            return ([], '')
-
-    def add_etag(self, etag, repo):
-        global etags
-        if etag:
-            etags[repo] = etag
-
-    def get_headers(self, repo):
-        global etags
-        if repo in etags.keys():
-            # Format the etag header for GitHub API:
-            etag = '"' + re.findall('\w\w+', etags[repo])[0] + '"'
-            return {**self.header, **{'If-None-Match': etag}}
-        return self.header
-
-    def get_etag(self, repo):
+    def get_stream(self, repo):
         return repo + '-pulls'
 
+    # The pulls API has no since parameter, so pages are followed back to the
+    # cursor only:
+    def get_params(self, cursor):
+        return {'sort': 'created', 'direction': 'desc', 'per_page': 100}
+
+    def from_event(self, event):
+        if (event['type'] == 'PullRequestEvent' and
+            event['payload']['action'] == 'opened'):
+            return [event['payload']['pull_request']]
+        return []
+
     def get_data(self):
-        repos_url = 'https://api.github.com/orgs/TeachersPayTeachers/repos'
-        repos = self.get_repos(repos_url)
-        data = []
-        for repo in repos:
-            url = self.get_url(repo['name'])
-            etag_name = self.get_etag(repo['name'])
-            headers = self.get_headers(etag_name)
-            #get_new_repo returns a tuple of the form (list_of_pulls, Etag)
-            new_repo = self.get_new_repo(url, headers)
-            data += new_repo[0]
-            self.add_etag(new_repo[1], etag_name)
-        return data
-
-    def get_repos(self, repos_url):
-        global TOKEN_HEADER
-        tpt_repos = requests.get(repos_url, headers=TOKEN_HEADER)
-        # If there are more pages of repos, get them recursively:
-        headers = tpt_repos.headers
-        if 'link' in headers.keys() and 'next' in headers['link']:
-            # Regex to parse URL from header:
-            url = re.findall('(?<=<)\S+(?=>)', headers['link'])[0]
-            return tpt_repos.json() + self.get_repos(url)
-        return tpt_repos.json()
+        global REPOS_URL
+        if self.events is not None:
+            return self.from_events()
+        if self.repos is None:
+            self.repos = get_repos(REPOS_URL)
+        return self.fetch_repos()
+
+    # map returns results in the same order as repos, so data and cursors are
+    # merged the same way no matter which fetch finishes first. Each repo's
+    # items are yielded as soon as it and the repos before it are fetched.
+    def fetch_repos(self):
+        global GITHUB_WORKERS
+        with ThreadPoolExecutor(max_workers=GITHUB_WORKERS) as executor:
+            for data in self.merge(executor.map(self.fetch_repo, self.repos)):
+                yield data
 
     def get_time(self, pull):
         return pull['created_at']
@@ -240,15 +471,10 @@ class Pulls(Notify):
     def get_user(self, pull):
         return pull['user']['login']
 
-    # If user_data is empty, call the GitHub users API:
+    # If user_data is empty, look up the user's GitHub profile:
     def check_user_data(self, pull):
-        global TOKEN_HEADER
         if not self.user_data:
-            user_url = 'https://api.github.com/users/' + pull['user']['login']
-            self.user_data = requests.get(
-                user_url,
-                headers=TOKEN_HEADER
-            ).json()
+            self.user_data = user_profiles.get(pull['user']['login'])
 
     def get_channels(self, user):
         return notifications_on('pull', user)
@@ -270,20 +496,23 @@ class Comments(Pulls):
 
     def get_url(self, repo):
         global GITHUB_API
-        url = GITHUB_API + repo + '/issues/comments'
-        etag_name = self.get_etag(repo)
-        headers = self.get_headers(etag_name)
-        # The newest comments are on the last page of comments. The link to the
-        # last page of comments is returned in the header of the API response.
-        response = requests.get(url, headers=headers)
-        # Regex to parse URL from header:
-        if 'link' in response.headers.keys():
-            return re.findall('(?<=<)\S+(?=>)', response.headers['link'])[1]
-        return url
+        return GITHUB_API + repo + '/issues/comments'
 
-    def get_etag(self, repo):
+    def get_stream(self, repo):
         return repo + '-comments'
 
+    def get_params(self, cursor):
+        return {
+            **Notify.get_params(self, cursor),
+            **{'sort': 'created', 'direction': 'desc'}
+        }
+
+    def from_event(self, event):
+        if (event['type'] == 'IssueCommentEvent' and
+            event['payload']['action'] == 'created'):
+            return [event['payload']['comment']]
+        return []
+
     def get_body(self, comment):
         return comment['body']
 
@@ -299,24 +528,115 @@ class Comments(Pulls):
             comment['url']
         )
 
-def main():
-    global current_time, etags, MAX_AGE
-    etags = get_etags.main()
+# Load state at the start of a cycle:
+def start_cycle():
+    global current_time, cursors, refreshed, lookback
+    lookback = MAX_AGE
+    snapshot.restore({
+        'github': load_state,
+        'mapping': get_slack_id.load_state
+    })
+    # Cursors saved before snapshots existed are read from the cursors file:
+    if not cursors:
+        cursors = get_etags.main('cursors')
+    get_slack_id.refresh_mapping()
+    refreshed = set()
     # Python datetime object representing current time in UTC:
     current_time = datetime.datetime.utcnow()
+
+# Notify about new commits, pulls and comments. If events is given, items are
+# read from those org events instead of being polled. Return the number of new
+# items.
+def run(events=None):
+    global cursors, REPOS_URL, GITHUB_STREAM_WORKERS
     notifications = [Commits(), Pulls(), Comments()]
+    repos = None
+    if events is None:
+        # Pulls and Comments poll the same repos, so list them once:
+        repos = get_repos(REPOS_URL)
     for notification in notifications:
-        notification.set_data()
-        notification.send_notifications()
-        track_notifications.clean(
-            # Unix time in milliseconds for track_notifications:
-            current_time.timestamp() * 1000,
-            # Convert seconds to milliseconds for track_notifications:
-            MAX_AGE * 1000,
-            notification.filename
-        )
-    with open('etags', 'w') as outfile:
-        json.dump(etags, outfile)
+        notification.events = events
+        if isinstance(notification, Pulls):
+            notification.repos = repos
+    with ThreadPoolExecutor(max_workers=GITHUB_STREAM_WORKERS) as executor:
+        new_items = sum(executor.map(run_stream, notifications))
+    # Merge cursors in a fixed order once every stream is done:
+    for notification in notifications:
+        cursors.update(notification.cursors)
+    return new_items
+
+# Fetch, notify and clean up one stream. Return the number of new items.
+# Items are tracked for as long as any run could look back to them, so that a
+# polling run doesn't notify again about items a webhook already did.
+def run_stream(notification):
+    global current_time, MAX_AGE, MAX_LOOKBACK
+    new_items = notification.send_notifications()
+    track_notifications.clean(
+        # Unix time in milliseconds for track_notifications:
+        current_time.timestamp() * 1000,
+        # Convert seconds to milliseconds for track_notifications:
+        (MAX_AGE + MAX_LOOKBACK) * 1000,
+        notification.filename
+    )
+    return new_items
+
+# Save state at the end of a cycle:
+def end_cycle():
+    snapshot.checkpoint({
+        'github': dump_state(),
+        'mapping': get_slack_id.dump_state()
+    })
+    user_profiles.save()
+
+# Return the cursors and subscription indexes as JSON-compatible values for
+# snapshot:
+def dump_state():
+    global cursors, subscription_index, subscription_etags, next_poll
+    global last_poll
+    return {
+        'cursors': cursors,
+        'subscription_index': subscription_index,
+        'subscription_etags': subscription_etags,
+        'next_poll': next_poll,
+        'last_poll': last_poll
+    }
+
+def load_state(state):
+    global cursors, subscription_index, subscription_etags, next_poll
+    global last_poll
+    cursors = state['cursors']
+    subscription_index = state['subscription_index']
+    subscription_etags = state['subscription_etags']
+    next_poll = state['next_poll']
+    last_poll = state['last_poll']
+
+# Notify about events delivered by webhook, in the same format as the org
+# events feed:
+def handle_events(events):
+    start_cycle()
+    run(events)
+    end_cycle()
+
+# Return the number of new items, which clock.py uses to adjust how often
+# this runs:
+def main():
+    global GITHUB_EVENTS, MAX_AGE, MAX_LOOKBACK, lookback, last_poll
+    start_cycle()
+    started = time.time()
+    # Look back to the start of the last polling run, so that nothing is
+    # missed however long the interval between runs was, including webhook
+    # events that never arrived:
+    if last_poll:
+        lookback = MAX_AGE + min(started - last_poll, MAX_LOOKBACK)
+    if GITHUB_EVENTS:
+        new_items = run(get_events())
+    else:
+        new_items = run()
+    last_poll = started
+    end_cycle()
+    snapshot.publish(new_items > 0)
+    return new_items
 
 if __name__ == '__main__':
     main()
+    slack_queue.drain()
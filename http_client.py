@@ -0,0 +1,87 @@
+# Shared HTTP sessions for GitHub, Slack and Jenkins. Each session keeps a pool
+# of keep-alive connections to its host, retries failed requests with backoff
+# and applies a default timeout. Requests and bytes are counted per host.
+import os
+import threading
+import requests
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# global constants:
+TIMEOUT = 10 #seconds
+POOL_SIZE = 16
+RETRIES = 3
+BACKOFF = 0.5 #seconds, doubled on each retry
+LOCK = threading.Lock()
+
+# global variables:
+# Dict of host to {'requests': count, 'bytes': count} since the last report:
+stats = {}
+# Dict of host to the number of requests since the process started:
+totals = {}
+# Dict of host to (requests remaining, Unix time the limit resets) from the
+# most recent X-RateLimit headers:
+rate_limits = {}
+
+def count(response, *args, **kwargs):
+    host = urlparse(response.url).netloc
+    with LOCK:
+        host_stats = stats.setdefault(host, {'requests': 0, 'bytes': 0})
+        host_stats['requests'] += 1
+        host_stats['bytes'] += len(response.content)
+        totals[host] = totals.get(host, 0) + 1
+        if 'X-RateLimit-Remaining' in response.headers:
+            rate_limits[host] = (
+                int(response.headers['X-RateLimit-Remaining']),
+                int(response.headers['X-RateLimit-Reset'])
+            )
+
+class Client(requests.Session):
+
+    def __init__(self, headers=None, timeout=TIMEOUT):
+        super().__init__()
+        if headers:
+            self.headers.update(headers)
+        self.timeout = timeout
+        # raise_on_status=False returns the last 5xx response once retries run
+        # out, instead of raising RetryError, so callers can check status_code:
+        retry = Retry(
+            total=RETRIES,
+            backoff_factor=BACKOFF,
+            status_forcelist=[500, 502, 503, 504],
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=POOL_SIZE,
+            pool_maxsize=POOL_SIZE,
+            max_retries=retry
+        )
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.hooks['response'].append(count)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+GITHUB = Client(
+    {'Authorization': 'token ' + os.environ.get('GITHUB_REPO_TOKEN', '')}
+)
+SLACK = Client()
+# Authentication and proxy for Jenkins are set in jenkins_slack_notifications.
+JENKINS = Client(timeout=3)
+
+# Print and reset the per-host counters:
+def report():
+    global stats
+    with LOCK:
+        for host in sorted(stats):
+            print(
+                '{}: {} requests, {} bytes'.format(
+                    host,
+                    stats[host]['requests'],
+                    stats[host]['bytes']
+                )
+            )
+        stats = {}
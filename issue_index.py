@@ -0,0 +1,117 @@
+# Index of open tpt pull requests by title and by branch, used to find the
+# assignees of the pull request a Jenkins build belongs to. expire() should be
+# called once per cycle; the first assignees() call after it revalidates every
+# page of pull requests through response_cache and only rebuilds the index when
+# something changed, so cycles that don't need assignees make no requests.
+# Titles that aren't in the index are looked up with the GitHub search API.
+import re
+import threading
+import http_client
+import response_cache
+
+# global constants:
+PULLS_URL = 'https://api.github.com/repos/TeachersPayTeachers/tpt/pulls'
+SEARCH_URL = 'https://api.github.com/search/issues'
+LOCK = threading.Lock()
+# Held while the index is refreshed, so that only one thread refreshes it:
+REFRESH_LOCK = threading.Lock()
+
+# global variables:
+by_title = {}
+by_branch = {}
+# ETags of the pages of pull requests the index was built from:
+index_etags = []
+# Titles looked up with the search API this cycle, including ones that weren't
+# found:
+searched = {}
+# True once the index has been refreshed this cycle:
+refreshed = False
+
+# Return every page of url, each revalidated through response_cache, or None
+# if any of them failed:
+def get_pages(url):
+    pages = []
+    while url:
+        response = response_cache.get(http_client.GITHUB, url)
+        if response.status_code >= 300:
+            return None
+        pages.append(response)
+        url = None
+        if 'link' in response.headers and 'next' in response.headers['link']:
+            # Regex to parse URL from header:
+            url = re.findall('<(\S+)>; rel="next"', response.headers['link'])[0]
+    return pages
+
+# Rebuild the index if any page of pull requests changed. The cache outlives
+# this process, so pages can be unchanged while the index is empty or was
+# restored from an older snapshot; comparing ETags catches that too.
+def refresh():
+    global by_title, by_branch, index_etags
+    pages = get_pages(PULLS_URL + '?state=open&per_page=100')
+    if pages is None:
+        return
+    etags = [page.headers.get('Etag') for page in pages]
+    with LOCK:
+        if etags == index_etags and not any(page.modified for page in pages):
+            return
+        by_title = {}
+        by_branch = {}
+        index_etags = etags
+        for page in pages:
+            for pull in page.json():
+                by_title.setdefault(pull['title'], pull['assignees'])
+                by_branch.setdefault(pull['head']['ref'], pull['assignees'])
+
+# Start a new cycle:
+def expire():
+    global searched, refreshed
+    with LOCK:
+        searched = {}
+        refreshed = False
+
+# Search for a pull request by exact title:
+def search(title):
+    query = '"{}" repo:TeachersPayTeachers/tpt is:pr in:title'.format(
+        title.replace('"', '')
+    )
+    response = http_client.GITHUB.get(SEARCH_URL, params={'q': query})
+    if response.status_code < 300:
+        for item in response.json()['items']:
+            if item['title'] == title:
+                return item['assignees']
+    return []
+
+# Return the list of assignees of the pull request for a branch or title:
+def assignees(title, branch=None):
+    global refreshed
+    with REFRESH_LOCK:
+        if not refreshed:
+            refresh()
+            refreshed = True
+    with LOCK:
+        if branch in by_branch:
+            return by_branch[branch]
+        if title in by_title:
+            return by_title[title]
+        if not title or title in searched:
+            return searched.get(title, [])
+    found = search(title)
+    with LOCK:
+        searched[title] = found
+    return found
+
+# Return the index as JSON-compatible values for snapshot:
+def dump_state():
+    with LOCK:
+        return {
+            'etags': index_etags,
+            'by_title': by_title,
+            'by_branch': by_branch
+        }
+
+def load_state(state):
+    global by_title, by_branch, index_etags
+    with LOCK:
+        by_title = state['by_title']
+        by_branch = state['by_branch']
+        index_etags = state['etags']
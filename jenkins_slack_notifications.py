@@ -1,33 +1,188 @@
 import json
 import track_notifications
 import os
-import requests
 import time
 import re
-from requests.auth import HTTPBasicAuth
+import threading
+import get_slack_id
+import http_client
+import issue_index
+import slack_queue
+import snapshot
+import user_profiles
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from get_slack_id import GetSlackID
 
 # global constants:
 HOSTNAME = 'http://qa.tptpm.info:8090'
-JENKINS = requests.Session()
+JENKINS = http_client.JENKINS
 # 1000000 milliseconds is about 15 minutes, long enough to catch builds that
 # took a while.
 MAX_AGE = 1000000
+# Builds older than MAX_AGE aren't notified about, but all_tests_passed still
+# needs the other builds triggered by the same upstream build, however long
+# ago they finished. Incremental mode keeps builds for this many milliseconds
+# (a day) for that:
+PIPELINE_MAX_AGE = 24 * 60 * 60 * 1000
+# Set JENKINS_INCREMENTAL=1 to only fetch the builds of jobs that have new
+# builds instead of every build of every job:
+JENKINS_INCREMENTAL = os.environ.get('JENKINS_INCREMENTAL') == '1'
+# Number of builds per job to fetch the first time a job is seen:
+FIRST_POLL_BUILDS = 20
+# Most builds to fetch for one job in one cycle:
+MAX_POLL_BUILDS = 100
+# Number of Naginator artifacts to fetch at once:
+NAGINATOR_WORKERS = 4
+# Number of groups of builds to notify about at once. Set to 1 to notify about
+# builds one at a time.
+JENKINS_WORKERS = int(os.environ.get('JENKINS_WORKERS', 8))
+PASSED_LOCK = threading.Lock()
+# Core-SyntaxCheck-PHP-DevCloud triggers 6 builds, listed here:
+FINAL_BUILDS = [
+    'Acceptance',
+    'CodeSniff',
+    'Unit-JS',
+    'Unit-PHP',
+    'API-Functional',
+    'API-Unit'
+]
+# Fields of each build requested from the Jenkins API:
+BUILD_FIELDS = 'actions['\
+        'causes['\
+            'shortDescription'\
+        ']'\
+    '],'\
+    'number,'\
+    'timestamp,'\
+    'result,'\
+    'url,'\
+    'changeSet['\
+        'items['\
+            'msg,'\
+            'author['\
+                'fullName,'\
+                'absoluteUrl'\
+            ']'\
+        ']{0}'\
+    '],'\
+    'fullDisplayName'
+BUILD_TREE = 'builds[' + BUILD_FIELDS + ']'
+# Regex to parse branch name from build name:
+BRANCH_PATTERN = re.compile('[()]')
+# Regex to parse number of upstream build from description of cause:
+NON_DIGITS = re.compile('[^0-9]')
+# A build we might notify about, as returned by make_build:
+Build = namedtuple('Build', [
+    'name',
+    'number',
+    'result',
+    'timestamp',
+    'url',
+    'author',
+    'user',
+    'branch',
+    'started_by_naginator',
+    'upstream',
+    'title'
+])
 
 # global variables:
 current_time = 0
-passed_notifications = []
+# Set of upstream builds already checked by all_tests_passed this cycle:
+passed_notifications = set()
+# Dict of job url to the highest build number such that it and every build
+# before it had finished when last fetched:
+watermarks = {}
+# Dict of build url to Build for builds fetched in incremental mode that are
+# newer than PIPELINE_MAX_AGE:
+recent_builds = {}
+# Dict of Acceptance build number to (naginator_count, naginator_maxcount).
+# Finished builds never change, so these are fetched once per build.
+naginator_counts = {}
+
+# Decode a Jenkins API response. Each build is replaced by make_build's output
+# as soon as it's decoded, so only the compact Build records are kept, and the
+# nested dicts of builds we don't notify about are dropped straight away. If
+# unfinished is given, the numbers of builds that haven't finished are added to
+# it.
+def parse_builds(response, unfinished=None):
+    def object_hook(data):
+        if 'fullDisplayName' not in data:
+            return data
+        if unfinished is not None and data['result'] is None:
+            unfinished.append(data['number'])
+        return make_build(data)
+    return json.loads(response.text, object_hook=object_hook)
 
 # Generate list of builds from dict returned by Jenkins API:
 def parse_build_data(build_data):
     output = []
     for job in build_data['jobs']:
-        for build in job['builds']:
-            output.append(make_build(build))
+        output += [build for build in job['builds'] if build]
     return output
 
-# Check if build contains necessary data and return it:
+# Fetch every build of every job:
+def get_all_builds():
+    global HOSTNAME, JENKINS, BUILD_TREE
+    url = '{}/api/json?tree=jobs[{}]'.format(HOSTNAME, BUILD_TREE)
+    return parse_build_data(parse_builds(JENKINS.get(url)))
+
+# Fetch only the builds after each job's watermark, using a range slice of the
+# job's builds (newest first). Builds fetched in earlier cycles are kept until
+# they're older than PIPELINE_MAX_AGE, since all_tests_passed needs the other
+# builds triggered by the same upstream build.
+def get_new_builds():
+    global HOSTNAME, JENKINS, BUILD_TREE, MAX_AGE, current_time
+    global FIRST_POLL_BUILDS, MAX_POLL_BUILDS, watermarks, recent_builds
+    url = '{}/api/json?tree=jobs[url,lastBuild[number]]'.format(HOSTNAME)
+    for job in JENKINS.get(url).json()['jobs']:
+        if not job.get('lastBuild'):
+            continue
+        last_build = job['lastBuild']['number']
+        watermark = watermarks.get(job['url'], last_build - FIRST_POLL_BUILDS)
+        if last_build <= watermark:
+            continue
+        count = min(last_build - watermark, MAX_POLL_BUILDS)
+        url = '{}api/json?tree={}{{0,{}}}'.format(job['url'], BUILD_TREE, count)
+        # Builds that haven't finished must be fetched again next cycle:
+        unfinished = []
+        builds = parse_builds(JENKINS.get(url), unfinished)['builds']
+        if unfinished:
+            watermarks[job['url']] = min(unfinished) - 1
+        else:
+            watermarks[job['url']] = last_build
+        for build in builds:
+            add_recent_build(build)
+    return get_recent_builds()
+
+# Fetch a single build, given its url, as returned by make_build:
+def get_build(url):
+    global JENKINS, BUILD_FIELDS
+    return parse_builds(JENKINS.get(url + 'api/json?tree=' + BUILD_FIELDS))
+
+def add_recent_build(build):
+    global recent_builds
+    if build:
+        recent_builds[build.url] = build
+
+# Forget builds older than PIPELINE_MAX_AGE and return the rest, newest first:
+def get_recent_builds():
+    global PIPELINE_MAX_AGE, current_time, recent_builds
+    for url in list(recent_builds):
+        if current_time - recent_builds[url].timestamp >= PIPELINE_MAX_AGE:
+            del recent_builds[url]
+    return sorted(
+        recent_builds.values(),
+        key=lambda build: build.timestamp,
+        reverse=True
+    )
+
+# Check if build contains necessary data and return it as a Build. Builds of
+# any age are returned, since index_builds needs them; notify_builds skips
+# the ones older than MAX_AGE.
 def make_build(build):
+    global BRANCH_PATTERN
     if (build['changeSet']['items'] and
         # Open paren in build name indicates branch information exists.
         '(' in build['fullDisplayName'] and
@@ -35,23 +190,22 @@ def make_build(build):
         'CodeSize' not in build['fullDisplayName']):
         user_url = build['changeSet']['items'][0]['author']['absoluteUrl']
         build_name = build['fullDisplayName']
-        return {
-            'build': build_name,
-            'number': build['number'],
-            'result': build['result'],
-            'timestamp': build['timestamp'],
-            'url': build['url'],
-            'author': build['changeSet']['items'][0]['author']['fullName'],
+        return Build(
+            name=build_name,
+            number=build['number'],
+            result=build['result'],
+            timestamp=build['timestamp'],
+            url=build['url'],
+            author=build['changeSet']['items'][0]['author']['fullName'],
             # Parse Jenkins username from url:
-            'user': user_url.split('/')[4],
-            # Regex to parse branch name from build:
-            'branch': re.split('[()]', build_name)[1],
-            'started_by_naginator': started_by_naginator(build['actions']),
-            'upstream': upstream(build['actions']),
+            user=user_url.split('/')[4],
+            branch=BRANCH_PATTERN.split(build_name)[1],
+            started_by_naginator=started_by_naginator(build['actions']),
+            upstream=upstream(build['actions']),
             # The title of the GitHub issue associated with this Jenkins build
             # is available in the following field in the Jenkins API.
-            'title': build['changeSet']['items'][0]['msg']
-        }
+            title=build['changeSet']['items'][0]['msg']
+        )
 
 def started_by_naginator(actions):
     for action in actions:
@@ -64,15 +218,13 @@ def started_by_naginator(actions):
 # started this build. If the build was started by some other action (some other
 # job, CLI, etc.), return 0.
 def upstream(actions):
+    global NON_DIGITS
     for action in actions:
         if ('causes' in action and
             'upstream' in action['causes'][0]['shortDescription'] and
             'Syntax' in action['causes'][0]['shortDescription']):
-            # Regex to parse number of upstream build from description of cause:
             return int(
-                re.sub('[^0-9]',
-                '', 
-                action['causes'][0]['shortDescription'])
+                NON_DIGITS.sub('', action['causes'][0]['shortDescription'])
             )
     return 0
 
@@ -83,53 +235,138 @@ def naginator_check(started_by_naginator, number, name):
         return False
     if not started_by_naginator:
         return True
+    counts = get_naginator_counts(number)
+    # If the artifacts can't be read, send the failure message rather than
+    # risk never sending one:
+    if counts is None:
+        return False
+    naginator_count, naginator_maxcount = counts
+    return naginator_count < naginator_maxcount
+
+def get_artifact(number, artifact):
+    global HOSTNAME, JENKINS
     job = '/job/Core-Acceptance-PHP-DevCloud/'
-    url = '{}{}{}{}'.format(
+    url = '{}{}{}{}{}'.format(
         HOSTNAME,
         job,
         str(number),
-        '/artifact/naginator_count'
+        '/artifact/',
+        artifact
     )
-    naginator_count = JENKINS.get(url)
-    url = '{}{}{}{}'.format(
-        HOSTNAME,
-        job,
-        str(number),
-        '/artifact/naginator_maxcount'
+    response = JENKINS.get(url)
+    if response.status_code != 200:
+        print('Error fetching {}: {}'.format(url, response.status_code))
+        return None
+    try:
+        return response.json()
+    except ValueError:
+        print('Error decoding ' + url)
+        return None
+
+# Return (naginator_count, naginator_maxcount) for an Acceptance build, fetching
+# both artifacts at once if they aren't already known. Return None if either
+# can't be read; that isn't cached, so it's tried again next time.
+def get_naginator_counts(number):
+    global naginator_counts
+    if number not in naginator_counts:
+        artifacts = ['naginator_count', 'naginator_maxcount']
+        with ThreadPoolExecutor(max_workers=len(artifacts)) as executor:
+            counts = tuple(executor.map(
+                lambda artifact: get_artifact(number, artifact),
+                artifacts
+            ))
+        if None in counts:
+            return None
+        naginator_counts[number] = counts
+    return naginator_counts[number]
+
+# Fetch the Naginator artifacts of every failed Acceptance build in builds that
+# naginator_check will need (those whose author gets failure notifications),
+# all at once, and forget builds that are gone:
+def prefetch_naginator_counts(builds):
+    global NAGINATOR_WORKERS, naginator_counts
+    numbers = set(
+        build.number for build in builds
+        if build.result == 'FAILURE' and
+        build.started_by_naginator and
+        'Acceptance' in build.name and
+        gets_failures(build)
+    )
+    for number in list(naginator_counts):
+        if number not in numbers:
+            del naginator_counts[number]
+    with ThreadPoolExecutor(max_workers=NAGINATOR_WORKERS) as executor:
+        list(executor.map(get_naginator_counts, numbers))
+
+# Return a dict of upstream build number to a dict of each final build to the
+# result of that final build. When several builds of the same final build were
+# triggered by one upstream build, the first one in builds is used.
+def index_builds(builds):
+    global FINAL_BUILDS
+    index = {}
+    for build in builds:
+        if build and build.upstream:
+            results = index.setdefault(build.upstream, {})
+            for final_build in FINAL_BUILDS:
+                if final_build in build.name:
+                    results.setdefault(final_build, build.result)
+    return index
+
+# Return the set of upstream builds whose final builds have all passed:
+def completed_upstreams(index):
+    global FINAL_BUILDS
+    return set(
+        upstream for upstream in index
+        if all(index[upstream].get(f) == 'SUCCESS' for f in FINAL_BUILDS)
     )
-    naginator_maxcount = JENKINS.get(url)
-    return naginator_count.json() < naginator_maxcount.json()
-        
-# Core-SyntaxCheck-PHP-DevCloud triggers 6 builds, listed here in final_builds.
-# Check if each of these builds, triggered by the same upstream build, have
+
+# Check if each of the final builds triggered by the same upstream build have
 # passed:
-def all_tests_passed(upstream, builds):
+def all_tests_passed(upstream, completed):
     global passed_notifications
-    if upstream == 0 or upstream in passed_notifications:
+    if upstream == 0:
         return False
-    passed_notifications.append(upstream)
-    final_builds = [
-        'Acceptance',
-        'CodeSniff',
-        'Unit-JS',
-        'Unit-PHP',
-        'API-Functional',
-        'API-Unit'
-    ]
-    for final_build in final_builds:
-        result = upstream_match(final_build, upstream, builds)
-        if not result == 'SUCCESS':
+    with PASSED_LOCK:
+        if upstream in passed_notifications:
             return False
-    return True
+        passed_notifications.add(upstream)
+    return upstream in completed
+
+# Split builds into groups such that builds by the same user or triggered by
+# the same upstream build are in the same group, in the order they're in in
+# builds. Groups can be notified about at once without reordering the
+# messages any one user gets or changing which build of an upstream build
+# sends the finish notification.
+def group_builds(builds):
+    parents = list(range(len(builds)))
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+    first = {}
+    for i, build in enumerate(builds):
+        keys = [('user', build.user)]
+        if build.upstream:
+            keys.append(('upstream', build.upstream))
+        for key in keys:
+            if key in first:
+                parents[find(i)] = find(first[key])
+            else:
+                first[key] = i
+    groups = {}
+    order = []
+    for i, build in enumerate(builds):
+        root = find(i)
+        if root not in groups:
+            groups[root] = []
+            order.append(root)
+        groups[root].append(build)
+    return [groups[root] for root in order]
 
-# Return the result of a certain build that was triggered by a certain upstream
-# build:
-def upstream_match(final_build, upstream, builds):
+def notify_group(builds, completed):
     for build in builds:
-        if (build and
-            upstream == build['upstream'] and
-            final_build in build['build']):
-            return build['result']
+        notify(build, completed)
 
 def append_assignee(output, user):
     if not output:
@@ -139,20 +376,11 @@ def append_assignee(output, user):
 # If a user has failure notifications and finish notifications turned on, they
 # will also be notified about the results of tests for pull requests that they
 # are assigned to.
-def assignees(title):
-    # Lists of assignees are in the GitHub issues API.
-    github_api = 'https://api.github.com/repos/TeachersPayTeachers/tpt/issues'
-    token_header = 'token ' + os.environ['GITHUB_REPO_TOKEN']
-    header = {'Authorization': token_header}
-    issues = requests.get(github_api, headers=header).json()
-    assignees_list = []
-    for issue in issues:
-        if not assignees_list and issue['title'] == title:
-            assignees_list = issue['assignees']
+def assignees(title, branch):
+    assignees_list = issue_index.assignees(title, branch)
     output = ''
     for assignee in assignees_list:
-        user_url = 'https://api.github.com/users/' + assignee['login']
-        user_data = requests.get(user_url, headers=header).json()
+        user_data = user_profiles.get(assignee['login'])
         user = GetSlackID(
             user_data['name'],
             user_data['email'],
@@ -162,25 +390,34 @@ def assignees(title):
             output += append_assignee(output, user.slack_name)
     return output
 
-def notify(build, builds):
-    email = build['user'] + '@teacherspayteachers.com'
-    user = GetSlackID(build['author'], email, build['user'])
+# Return the Slack user for the author of a build:
+def get_user(build):
+    email = build.user + '@teacherspayteachers.com'
+    return GetSlackID(build.author, email, build.user)
+
+def gets_failures(build):
+    user = get_user(build)
+    return user.exists and user.notify_on_failure
+
+# completed is the set of upstream builds returned by completed_upstreams:
+def notify(build, completed):
+    user = get_user(build)
     if user.exists:
         # If the user has failure notifications turned on and the build failed
         # and the build is not being re-run by Naginator, then send a failure
         # message:
         if (user.notify_on_failure and
-            build['result'] == 'FAILURE' and not
+            build.result == 'FAILURE' and not
             naginator_check(
-                build['started_by_naginator'],
-                build['number'],
-                build['build']
+                build.started_by_naginator,
+                build.number,
+                build.name
             )):
             message = (
-                build['build'] +
+                build.name +
                 ' failed: ' +
-                build['url'] +
-                assignees(build['title'])
+                build.url +
+                assignees(build.title, build.branch)
             )
             slack(user.slack_name, message)
         # If the user has finish notifications turned on and the build passed,
@@ -188,112 +425,164 @@ def notify(build, builds):
         # triggered this build have also passed, and if so, then send a finish
         # notification:
         if (user.notify_on_finish and
-            build['result'] == 'SUCCESS' and
-            all_tests_passed(build['upstream'], builds)):
+            build.result == 'SUCCESS' and
+            all_tests_passed(build.upstream, completed)):
             syntax_job = '/job/Core-SyntaxCheck-PHP-DevCloud/'
             syntax_url = '{}{}{}{}'.format(
                 HOSTNAME,
                 syntax_job,
-                str(build['upstream']),
+                str(build.upstream),
                 '/changes'
             )
             message = (
                 'All tests triggered by upstream build #' +
-                str(build['upstream']) +
+                str(build.upstream) +
                 ' passed: ' +
                 syntax_url +
-                assignees(build['title'])
+                assignees(build.title, build.branch)
             )
             slack(user.slack_name, message)
         # Success notification for builds not in the core pipeline:
-        if ('Core' not in build['build'] and
+        if ('Core' not in build.name and
             user.notify_on_failure and
             user.notify_on_finish and
-            build['result'] == 'SUCCESS'):
+            build.result == 'SUCCESS'):
             message = (
-                build['build'] +
+                build.name +
                 ' passed: ' +
-                build['url'] +
-                assignees(build['title'])
+                build.url +
+                assignees(build.title, build.branch)
             )
             slack(user.slack_name, message)
         # Notifications for unusual build statuses (ABORTED, UNSTABLE, etc.):
         if (user.notify_on_failure and
             user.notify_on_finish and
-            build['result'] and
-            build['result'] != 'SUCCESS' and
-            build['result'] != 'FAILURE'):
+            build.result and
+            build.result != 'SUCCESS' and
+            build.result != 'FAILURE'):
             message = (
-                build['build'] +
+                build.name +
                 ' was ' +
-                build['result'] +
+                build.result +
                 ': ' +
-                build['url'] +
-                assignees(build['title'])
+                build.url +
+                assignees(build.title, build.branch)
             )
             slack(user.slack_name, message)
     # Add this build to the list of builds already handled:
-    if build['result']:
+    if build.result:
         track_notifications.track(
-            build['number'],
-            build['timestamp'],
+            build.number,
+            build.timestamp,
             'build_numbers'
         )
 
 def slack(user, message):
-    params = {
-        'token': os.environ['BUILD_BOT_API_TOKEN'],
+    slack_queue.enqueue({
         'channel': '#build-notifications',
         'text': '@{}: {}'.format(user, message),
         'link_names': 1,
         'as_user': True
-    }
-    requests.get('https://slack.com/api/chat.postMessage', params=params)
+    })
 
-def main():
-    global HOSTNAME, JENKINS, MAX_AGE
-    global current_time, passed_notifications
-    passed_notifications = []
+# Set up state at the start of a cycle:
+def start_cycle():
+    global JENKINS, current_time, passed_notifications
+    passed_notifications = set()
+    snapshot.restore({
+        'jenkins': load_state,
+        'issue_index': issue_index.load_state,
+        'mapping': get_slack_id.load_state
+    })
+    # The mapping and pull request index are only refreshed when a build needs
+    # them, so idle cycles make no GitHub requests:
+    issue_index.expire()
     # Convert time to milliseconds for comparison to Jenkins timestamp:
     current_time = time.time() * 1000
     JENKINS.auth = ('sneagle', os.environ['JENKINS_API_TOKEN'])
-    JENKINS.timeout = 3
     JENKINS.proxies = {'http': os.environ['PROXIMO_URL']}
-    jenkins_api = '/api/json?tree=jobs['\
-        'builds['\
-            'actions['\
-                'causes['\
-                    'shortDescription'\
-                ']'\
-            '],'\
-            'number,'\
-            'timestamp,'\
-            'result,'\
-            'url,'\
-            'changeSet['\
-                'items['\
-                    'msg,'\
-                    'author['\
-                        'fullName,'\
-                        'absoluteUrl'\
-                    ']'\
-                ']{0}'\
-            '],'\
-            'fullDisplayName'\
-        ']'\
-    ']'
-    url = '{}{}'.format(HOSTNAME, jenkins_api)
-    builds = parse_build_data(JENKINS.get(url).json())
-    for build in builds:
-        if (build and
-            current_time - build['timestamp'] < MAX_AGE and 
-            build['branch'] != 'master' and not 
-            track_notifications.already_notified(
-                build['number'],
-                'build_numbers'
-            )):
-            notify(build, builds)
+
+# Notify about every build in builds that is new, has finished and hasn't been
+# notified yet, and return how many there were. Running builds are left for a
+# later cycle; they aren't tracked, so counting them would look like activity
+# every cycle.
+def notify_builds(builds):
+    global MAX_AGE, current_time
+    completed = completed_upstreams(index_builds(builds))
+    new_builds = [build for build in builds if
+        build and
+        build.result and
+        current_time - build.timestamp < MAX_AGE and
+        build.branch != 'master' and not
+        track_notifications.already_notified(
+            build.number,
+            'build_numbers'
+        )]
+    if new_builds:
+        get_slack_id.refresh_mapping()
+    prefetch_naginator_counts(new_builds)
+    with ThreadPoolExecutor(max_workers=JENKINS_WORKERS) as executor:
+        list(executor.map(
+            lambda group: notify_group(group, completed),
+            group_builds(new_builds)
+        ))
+    return len(new_builds)
+
+def end_cycle():
+    global MAX_AGE, current_time
     track_notifications.clean(current_time, MAX_AGE, 'build_numbers')
+    snapshot.checkpoint({
+        'jenkins': dump_state(),
+        'issue_index': issue_index.dump_state(),
+        'mapping': get_slack_id.dump_state()
+    })
+    user_profiles.save()
+
+# Return the watermarks, recent builds and Naginator counts as JSON-compatible
+# values for snapshot:
+def dump_state():
+    global watermarks, recent_builds, naginator_counts
+    return {
+        'watermarks': watermarks,
+        'recent_builds': list(recent_builds.values()),
+        'naginator_counts': [
+            [number] + list(counts)
+            for number, counts in naginator_counts.items()
+        ]
+    }
+
+def load_state(state):
+    global watermarks, recent_builds, naginator_counts
+    watermarks = state['watermarks']
+    recent_builds = {}
+    for values in state['recent_builds']:
+        add_recent_build(Build._make(values))
+    naginator_counts = dict(
+        (counts[0], tuple(counts[1:])) for counts in state['naginator_counts']
+    )
+
+# Notify about a build reported by the Jenkins notification plugin. The build
+# is added to the builds kept by incremental polling, so all_tests_passed can
+# see the other builds triggered by the same upstream build.
+def handle_build(url):
+    start_cycle()
+    add_recent_build(get_build(url))
+    notify_builds(get_recent_builds())
+    end_cycle()
+
+# Return the number of new builds, which clock.py uses to adjust how often
+# this runs:
+def main():
+    global JENKINS_INCREMENTAL
+    start_cycle()
+    if JENKINS_INCREMENTAL:
+        new_builds = notify_builds(get_new_builds())
+    else:
+        new_builds = notify_builds(get_all_builds())
+    end_cycle()
+    snapshot.publish(new_builds > 0)
+    return new_builds
 
 if __name__ == '__main__':
     main()
+    slack_queue.drain()
@@ -1,58 +1,88 @@
-import yaml
 import csv
 import push_to_github
 import users_to_yaml
-from base64 import b64encode
 
-def user_is_already_mapped(user, csvfile):
-    mapping = csv.DictReader(csvfile, lineterminator='\n')
-    for mapped_user in mapping:
-        if user in mapped_user.values():
-            return True
-    return False
+# global constants:
+FIELDNAMES = [
+    'real_name',
+    'slack_name',
+    'slack_id',
+    'email',
+    'notify_on_finish',
+    'notify_on_failure'
+]
 
-def make_new_user(user, slack_mapping):
+def make_new_user(member):
     return {
-        'real_name': slack_mapping[user]['real_name'],
-        'slack_name': user,
-        'slack_id': slack_mapping[user]['id'],
-        'email': slack_mapping[user]['email'],
+        'real_name': member['real_name'],
+        'slack_name': member['name'],
+        'slack_id': member['id'],
+        'email': member['email'],
         'notify_on_finish': False,
         'notify_on_failure': False
     }
 
-def get_new_users(csvfile, slack_mapping):
-    new_users = []
-    for user in slack_mapping:
-        csvfile.seek(0, 0)
-        if not user_is_already_mapped(user, csvfile):
-            new_users.append(make_new_user(user, slack_mapping))
-    return new_users
- 
+# Index mapping rows by Slack id, and collect every value in the mapping for
+# rows that don't have an id:
+def index_mapping(rows):
+    by_id = {}
+    values = set()
+    for row in rows:
+        if row.get('slack_id'):
+            by_id[row['slack_id']] = row
+        values.update(row.values())
+    return (by_id, values)
+
+# Update the mapping from a single pass over the Slack members. New members
+# are appended, renamed members get their new name, email and real name, and
+# deactivated members are removed. Return True if anything changed.
+def sync_users(rows, members):
+    by_id, values = index_mapping(rows)
+    deleted = set()
+    changed = False
+    for member in members:
+        row = by_id.get(member['id'])
+        if member['deleted']:
+            if row:
+                deleted.add(member['id'])
+            continue
+        if row:
+            for field, key in [
+                ('slack_name', 'name'),
+                ('email', 'email'),
+                ('real_name', 'real_name')
+            ]:
+                if member[key] and row.get(field) != member[key]:
+                    row[field] = member[key]
+                    changed = True
+        elif member['name'] not in values:
+            new_user = make_new_user(member)
+            rows.append(new_user)
+            by_id[member['id']] = new_user
+            changed = True
+    if deleted:
+        rows[:] = [row for row in rows if row.get('slack_id') not in deleted]
+        changed = True
+    return changed
+
 def main():
-    # Call script to pull list of users from Slack API and write to YAML:
-    users_to_yaml.main()
-    slack_mapping = yaml.safe_load(open('user_mapping.yaml', 'r'))
-    # Get a list of users who aren't in mapping.csv:
     with open('mapping.csv', 'r', newline='') as csvfile:
-        new_users = get_new_users(csvfile, slack_mapping)
-    # Append the new users to mapping.csv:
-    with open('mapping.csv', 'a', newline='') as csvfile:
-        fieldnames = [
-            'real_name', 
-            'slack_name',
-            'slack_id', 
-            'email', 
-            'notify_on_finish',
-            'notify_on_failure'
-        ]
+        reader = csv.DictReader(csvfile, lineterminator='\n')
+        fieldnames = reader.fieldnames or FIELDNAMES
+        rows = list(reader)
+    members = users_to_yaml.get_member_data(
+        users_to_yaml.get_members_from_api()
+    )
+    if not sync_users(rows, members):
+        return
+    with open('mapping.csv', 'w', newline='') as csvfile:
         writer = csv.DictWriter(
             csvfile,
             fieldnames=fieldnames,
             lineterminator='\n'
         )
-        for user in new_users:
-            writer.writerow(user)
+        writer.writeheader()
+        writer.writerows(rows)
     push_to_github.main('mapping.csv', 'Updated mapping.')
 
 if __name__ == '__main__':
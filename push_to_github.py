@@ -1,8 +1,24 @@
 import json
-import os
-import requests
+import threading
+import http_client
+import response_cache
 from base64 import b64encode
 
+# global constants:
+LOCK = threading.Lock()
+
+# global variables:
+# Dict of filename to the blob sha returned by our last upload of that file,
+# which saves looking it up again before the next upload:
+shas = {}
+
+# Return the sha of the file in the repo, or None if it doesn't exist yet:
+def get_sha(file_url):
+    response = response_cache.get(http_client.GITHUB, file_url)
+    if response.status_code == 404:
+        return None
+    return response.json()['sha']
+
 def main(filename, commit_message):
     # Convert file to byte object:
     with open(filename, 'r', newline='') as infile:
@@ -15,12 +31,31 @@ def main(filename, commit_message):
         'slack-mapping/'\
         'contents/'
     file_url += filename
-    token_header = 'token ' + os.environ['GITHUB_REPO_TOKEN']
-    header = {'Authorization': token_header}
-    file_sha = requests.get(file_url, headers=header).json()['sha']
+    with LOCK:
+        file_sha = shas.get(filename)
+    if not file_sha:
+        file_sha = get_sha(file_url)
     upload = {
         'message': commit_message,
-        'sha': file_sha,
         'content': str(updated_file, 'utf-8')
     }
-    requests.put(file_url, data=json.dumps(upload), headers=header)
+    # A new file is created by leaving out the sha:
+    if file_sha:
+        upload['sha'] = file_sha
+    response = http_client.GITHUB.put(file_url, data=json.dumps(upload))
+    # 409 means the file was changed by someone else since our last upload:
+    if response.status_code == 409 and filename in shas:
+        upload['sha'] = get_sha(file_url)
+        if not upload['sha']:
+            del upload['sha']
+        response = http_client.GITHUB.put(file_url, data=json.dumps(upload))
+    with LOCK:
+        if response.status_code < 300:
+            shas[filename] = response.json()['content']['sha']
+        else:
+            shas.pop(filename, None)
+    # Raise so that callers know the file wasn't saved and can try again:
+    if response.status_code >= 300:
+        raise RuntimeError(
+            'Error pushing {}: {}'.format(filename, response.status_code)
+        )
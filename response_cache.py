@@ -0,0 +1,162 @@
+# Cache of JSON API responses keyed by URL. Requests made through get() send
+# the cached ETag and Last-Modified, and a 304 Not Modified is answered with
+# the cached body, so callers get the data either way. Bodies are kept in the
+# state_store database, and the least recently used are evicted past MAX_BYTES.
+import json
+import threading
+import time
+import state_store
+from requests.models import PreparedRequest
+from requests.structures import CaseInsensitiveDict
+
+# global constants:
+MAX_BYTES = 50 * 1024 * 1024
+MAX_ENTRIES = 10000
+# Response headers kept with the body, since a 304 may not repeat them:
+CACHED_HEADERS = ['Etag', 'Last-Modified', 'Link']
+# Key of [total size of the cached bodies, number of them] in the state table.
+# They're kept in the database, not in memory, since other processes add and
+# evict responses too.
+TOTALS = 'response_cache.totals'
+LOCK = threading.Lock()
+
+# global variables:
+connection = None
+
+class CachedResponse:
+
+    # modified is False when the body came from the cache:
+    def __init__(self, response, body, headers, modified):
+        self.status_code = 200
+        self.headers = CaseInsensitiveDict(headers)
+        self.headers.update(response.headers)
+        self.body = body
+        self.modified = modified
+
+    def json(self):
+        return self.body
+
+def get_connection():
+    global connection
+    if not connection:
+        state_store.get_connection()
+        connection = state_store.connect()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'url TEXT PRIMARY KEY, '
+            'headers TEXT NOT NULL, '
+            'body TEXT NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'used REAL NOT NULL)'
+        )
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS responses_used ON responses (used)'
+        )
+        connection.commit()
+        with state_store.transaction(connection):
+            if state_store.read(connection, TOTALS, None) is None:
+                state_store.write(connection, TOTALS, connection.execute(
+                    'SELECT COALESCE(SUM(size), 0), COUNT(*) FROM responses'
+                ).fetchone())
+    return connection
+
+def get_key(url, params):
+    request = PreparedRequest()
+    request.prepare_url(url, params)
+    return request.url
+
+def lookup(key):
+    with LOCK:
+        row = get_connection().execute(
+            'SELECT headers, body FROM responses WHERE url = ?',
+            (key,)
+        ).fetchone()
+        if row:
+            with state_store.transaction(get_connection()):
+                get_connection().execute(
+                    'UPDATE responses SET used = ? WHERE url = ?',
+                    (time.time(), key)
+                )
+    if row:
+        return (json.loads(row[0]), row[1])
+
+def store(key, headers, text):
+    with LOCK, state_store.transaction(get_connection()):
+        total_size, entries = state_store.read(get_connection(), TOTALS, None)
+        old = get_connection().execute(
+            'SELECT size FROM responses WHERE url = ?',
+            (key,)
+        ).fetchone()
+        if old:
+            total_size -= old[0]
+            entries -= 1
+        get_connection().execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+            (key, json.dumps(headers), text, len(text), time.time())
+        )
+        total_size += len(text)
+        entries += 1
+        # Evict the least recently used responses:
+        while total_size > MAX_BYTES or entries > MAX_ENTRIES:
+            url, size = get_connection().execute(
+                'SELECT url, size FROM responses ORDER BY used LIMIT 1'
+            ).fetchone()
+            get_connection().execute(
+                'DELETE FROM responses WHERE url = ?',
+                (url,)
+            )
+            total_size -= size
+            entries -= 1
+        state_store.write(get_connection(), TOTALS, [total_size, entries])
+
+# Return the most recently used responses other than the one for skipped_url,
+# as [url, headers, body] lists with no more than max_bytes of bodies in all,
+# for snapshot:
+def dump_state(max_bytes, skipped_url):
+    entries = []
+    with LOCK:
+        for url, headers, body, size in get_connection().execute(
+            'SELECT url, headers, body, size FROM responses ORDER BY used DESC'
+        ):
+            if url != skipped_url and size <= max_bytes:
+                entries.append([url, json.loads(headers), body])
+                max_bytes -= size
+    return entries
+
+# Cache the responses from dump_state that aren't cached already:
+def load_state(entries):
+    for url, headers, body in entries:
+        with LOCK:
+            cached = get_connection().execute(
+                'SELECT 1 FROM responses WHERE url = ?',
+                (url,)
+            ).fetchone()
+        if not cached:
+            store(url, headers, body)
+
+# Make a conditional GET with session (one of the http_client sessions). The
+# caller's headers override the cached validators. The response's modified
+# attribute is True only if it has a new body. A 304 for a URL that isn't
+# cached, and errors, are returned as they are.
+def get(session, url, params=None, headers=None):
+    key = get_key(url, params)
+    cached = lookup(key)
+    request_headers = {}
+    if cached:
+        if 'Etag' in cached[0]:
+            request_headers['If-None-Match'] = cached[0]['Etag']
+        if 'Last-Modified' in cached[0]:
+            request_headers['If-Modified-Since'] = cached[0]['Last-Modified']
+    request_headers.update(headers or {})
+    response = session.get(url, params=params, headers=request_headers)
+    if response.status_code == 304 and cached:
+        return CachedResponse(response, json.loads(cached[1]), cached[0], False)
+    if response.status_code != 200:
+        response.modified = False
+        return response
+    kept = dict(
+        (header, response.headers[header])
+        for header in CACHED_HEADERS if header in response.headers
+    )
+    store(key, kept, response.text)
+    return CachedResponse(response, response.json(), kept, True)
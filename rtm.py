@@ -2,16 +2,117 @@ import yaml
 import csv
 import re
 import os
+import time
+import threading
+import selectors
+import signal
+import sys
+import atexit
 import push_to_github
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from slackclient import SlackClient
 
 #global constants
 SC = SlackClient(os.environ['BUILD_BOT_API_TOKEN'])
+# Number of commands to handle at once:
+RTM_WORKERS = int(os.environ.get('RTM_WORKERS', 4))
+# Seconds to wait for the websocket before checking it again anyway:
+SELECT_TIMEOUT = 1
+# Seconds to wait after a change to a state file for more changes before
+# writing it and pushing it to GitHub as one commit:
+FLUSH_DELAY = 5
+SEND_LOCK = threading.Lock()
+# One lock per state file, so changes to the same file are made one at a time:
+FILE_LOCKS = defaultdict(threading.Lock)
 
-def subscribe(channel, user, command):
+#global variables
+# In-memory copies of the state files, loaded on first use. Changes are made
+# here and written out by flush.
+subscriptions = {}
+mapping = []
+# Dicts of filename to its pending flush timer and commit message:
+timers = {}
+commit_messages = {}
+
+# Commands are handled on worker threads, which share the websocket:
+def send_message(channel, message):
     global SC
+    with SEND_LOCK:
+        SC.rtm_send_message(channel, message)
+
+def get_subscriptions(command):
+    global subscriptions
+    if command not in subscriptions:
+        filename = command + '_subscriptions.yaml'
+        subscriptions[command] = yaml.safe_load(open(filename, 'r'))
+    return subscriptions[command]
+
+def get_mapping():
+    global mapping
+    if not mapping:
+        with open('mapping.csv', 'r', newline='') as csvfile:
+            mapping = list(csv.DictReader(csvfile, lineterminator='\n'))
+    return mapping
+
+# Write a state file from memory and push it to GitHub. Runs on a timer
+# thread, so it may find that an earlier timer already flushed its changes. If
+# the push fails, it's tried again after another FLUSH_DELAY seconds.
+def flush(filename):
+    with FILE_LOCKS[filename]:
+        timers.pop(filename, None)
+        commit_message = commit_messages.pop(filename, None)
+        if not commit_message:
+            return
+        if filename == 'mapping.csv':
+            with open(filename, 'w', newline='') as csvfile:
+                writer = csv.DictWriter(
+                    csvfile,
+                    mapping[0].keys(),
+                    lineterminator='\n'
+                )
+                writer.writeheader()
+                writer.writerows(mapping)
+        else:
+            command = filename.split('_')[0]
+            with open(filename, 'w') as outfile:
+                yaml.dump(get_subscriptions(command), outfile, width=1000)
+        try:
+            push_to_github.main(filename, commit_message)
+        except Exception as error:
+            print('Error pushing ' + filename + ': ' + repr(error))
+            schedule_flush(filename, commit_message)
+
+# Flush a state file FLUSH_DELAY seconds after the last change to it. Must be
+# called with the file's lock held.
+def schedule_flush(filename, commit_message):
+    global FLUSH_DELAY
+    if filename in timers:
+        timers[filename].cancel()
+    commit_messages[filename] = commit_message
+    timers[filename] = threading.Timer(FLUSH_DELAY, flush, [filename])
+    timers[filename].daemon = True
+    timers[filename].start()
+
+# Flush every state file with pending changes right away, so that they aren't
+# lost when the process exits before their timers fire:
+def flush_all():
+    for filename in list(timers):
+        timers[filename].cancel()
+        flush(filename)
+
+# Heroku stops a dyno with SIGTERM. Exit normally instead, so that flush_all
+# runs:
+def exit_on_signal(signum, frame):
+    sys.exit(0)
+
+def subscribe(channel, user, command):
     filename = command + '_subscriptions.yaml'
-    channel_subscriptions = yaml.safe_load(open(filename, 'r'))
+    with FILE_LOCKS[filename]:
+        update_subscriptions(channel, user, command, filename)
+
+def update_subscriptions(channel, user, command, filename):
+    channel_subscriptions = get_subscriptions(command)
     # If this channel is already subscribed to some users, append the user, 
     # otherwise create a new dict entry:
     print('channel = ' + channel)
@@ -31,16 +132,18 @@ def subscribe(channel, user, command):
             command +
             "s."
         )
-        SC.rtm_send_message(channel, message)
-    with open(filename, 'w') as outfile:
-        yaml.dump(channel_subscriptions, outfile, width=1000)
-    push_to_github.main(filename, 'Updated ' + command + ' subscriptions.')
+        send_message(channel, message)
+        return
+    schedule_flush(filename, 'Updated ' + command + ' subscriptions.')
 
 def unsubscribe(channel, user, command):
-    global SC
-    message = ''
     filename = command + '_subscriptions.yaml'
-    channel_subscriptions = yaml.safe_load(open(filename, 'r'))
+    with FILE_LOCKS[filename]:
+        remove_subscription(channel, user, command, filename)
+
+def remove_subscription(channel, user, command, filename):
+    message = ''
+    channel_subscriptions = get_subscriptions(command)
     # If this channel is subscribed to this user, remove the user, otherwise 
     # send a message:
     if (channel in channel_subscriptions and
@@ -57,29 +160,13 @@ def unsubscribe(channel, user, command):
             "s, but ok..."
         )
     if message:
-        SC.rtm_send_message(channel, message)
-    with open(filename, 'w') as outfile:
-        yaml.dump(channel_subscriptions, outfile, width=1000)
-    push_to_github.main(filename, 'Updated ' + command + ' subscriptions.')
+        send_message(channel, message)
+    else:
+        schedule_flush(filename, 'Updated ' + command + ' subscriptions.')
 
 def update_mapping(notification, user, is_off):
-    new_mapping = []
-    with open('mapping.csv', 'r', newline='') as csvfile:
-        mapping = csv.DictReader(csvfile, lineterminator='\n')
-        for row in mapping:
-            new_mapping.append(row)
-    for row in new_mapping:
-        if user in row.values():
-            row[notification] = not is_off
-    with open('mapping.csv', 'w', newline='') as csvfile:
-        writer = csv.DictWriter(
-            csvfile,
-            new_mapping[0].keys(),
-            lineterminator='\n'
-        )
-        writer.writeheader()
-        writer.writerows(new_mapping)
-    push_to_github.main('mapping.csv', 'Updated mapping.')
+    with FILE_LOCKS['mapping.csv']:
+        set_notification(notification, user, is_off)
     if is_off:
         on_or_off = "won't"
     else:
@@ -92,6 +179,12 @@ def update_mapping(notification, user, is_off):
         ' let you know in #build-notifications when your Jenkins builds '
     )
 
+def set_notification(notification, user, is_off):
+    for row in get_mapping():
+        if user in row.values():
+            row[notification] = not is_off
+    schedule_flush('mapping.csv', 'Updated mapping.')
+
 # This bot has mandatory fun!
 def random_response():
     r = int.from_bytes(os.urandom(1), byteorder='big')
@@ -107,14 +200,13 @@ def get_command(text):
     return ['commit', 'commits to master.']
 
 def process(message):
-    global SC
     outgoing_message = ''
     # Get everything in the message after the mention of @build_notifications:
     try:
         you_said = message['text'].split(' ', 1)[1]
     except IndexError:
         you_said = ''
-        SC.rtm_send_message(message['channel'], ':confounded:')
+        send_message(message['channel'], ':confounded:')
     # Regex to parse user IDs from message:
     users = re.findall('(?<=@)\w+(?=>)', you_said)
     command = get_command(you_said)
@@ -160,23 +252,56 @@ def process(message):
         users_message += ('> and <@' + users[len(users) - 1] + '> ')
         outgoing_message = stop_or_start + users_message + command[1]
     if outgoing_message:
-        SC.rtm_send_message(message['channel'], outgoing_message)
+        send_message(message['channel'], outgoing_message)
     else:
-        SC.rtm_send_message(message['channel'], ':confounded:')
+        send_message(message['channel'], ':confounded:')
+
+# Handle a command on a worker thread and log how long it waited and took:
+def handle(message, received):
+    started = time.time()
+    try:
+        process(message)
+    except Exception as error:
+        print('Error handling command: ' + repr(error))
+    print(
+        'Handled command in {:.2f}s after waiting {:.2f}s.'.format(
+            time.time() - started,
+            started - received
+        )
+    )
 
-def get_messages(messages):
+def get_messages(messages, executor):
     build_bot_mention_string = '<@U1R49SZNK>'
     for message in messages:
         # Check if the message mentions @build_notifications:
         if ('text' in message and
             build_bot_mention_string in message['text']):
-            process(message)
+            executor.submit(handle, message, time.time())
 
-def main():
+# Hand every message that's already arrived to get_messages. rtm_read may not
+# return every frame at once, and frames already decrypted into the SSL
+# buffer don't make the socket readable, so keep reading until it's empty.
+def read_messages(executor):
     global SC
+    while True:
+        messages = SC.rtm_read()
+        if not messages:
+            return
+        get_messages(messages, executor)
+
+# Wait for the websocket to be readable instead of polling it, and hand
+# commands to a pool of workers so a slow GitHub push doesn't hold up the rest.
+def main():
+    global SC, RTM_WORKERS, SELECT_TIMEOUT
+    atexit.register(flush_all)
+    signal.signal(signal.SIGTERM, exit_on_signal)
     if SC.rtm_connect():
-        while True:
-            get_messages(SC.rtm_read())
+        selector = selectors.DefaultSelector()
+        selector.register(SC.server.websocket.sock, selectors.EVENT_READ)
+        with ThreadPoolExecutor(max_workers=RTM_WORKERS) as executor:
+            while True:
+                read_messages(executor)
+                selector.select(SELECT_TIMEOUT)
     else:
         print('Connection failed.')
 
@@ -0,0 +1,170 @@
+# Durable queue for Slack messages. Notifiers call enqueue() and return right
+# away; a pool of sender threads posts queued messages to chat.postMessage.
+# Messages for one channel are sent in order, at most RATE per second (with
+# bursts of up to BURST), and a channel is paused for as long as Slack's
+# Retry-After header asks. The queue is kept in the state_store database, so
+# messages can be queued by other processes too.
+import os
+import json
+import threading
+import time
+import http_client
+import state_store
+
+# global constants:
+SLACK_API = 'https://slack.com/api/chat.postMessage'
+WORKERS = int(os.environ.get('SLACK_WORKERS', 4))
+RATE = 1 #messages per second per channel
+BURST = 3
+ERROR_DELAY = 5 #seconds to wait before retrying a channel after an error
+# Seconds between checks for messages queued by other processes while the
+# queue is empty:
+POLL_INTERVAL = 1
+CONDITION = threading.Condition()
+
+# global variables:
+connection = None
+workers = []
+# Channels with a message being sent right now:
+in_flight = set()
+# Dict of channel to [tokens, time of last refill]:
+buckets = {}
+# Dict of channel to the time it can be sent to again after a 429:
+blocked_until = {}
+# Seconds each message sent since the last report spent in the queue:
+waits = []
+
+def get_connection():
+    global connection
+    if not connection:
+        connection = state_store.connect()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'channel TEXT NOT NULL, '
+            'params TEXT NOT NULL, '
+            'enqueued REAL NOT NULL)'
+        )
+        connection.commit()
+    return connection
+
+# params are the chat.postMessage parameters without the token, which is
+# added when the message is sent so that it's never written to disk.
+def enqueue(params):
+    with CONDITION:
+        get_connection().execute(
+            'INSERT INTO messages (channel, params, enqueued) VALUES (?, ?, ?)',
+            (params['channel'], json.dumps(params), time.time())
+        )
+        get_connection().commit()
+        CONDITION.notify()
+
+# Take a token from a channel's bucket. Return 0 if a token was taken,
+# otherwise the number of seconds until one is available.
+def take_token(channel, now):
+    tokens, last = buckets.get(channel, [BURST, now])
+    tokens = min(BURST, tokens + (now - last) * RATE)
+    if tokens < 1:
+        buckets[channel] = [tokens, now]
+        return (1 - tokens) / RATE
+    buckets[channel] = [tokens - 1, now]
+    return 0
+
+# Return the oldest message that can be sent now, or None and the number of
+# seconds until one can be. Only the oldest message of each channel is
+# considered, so each channel's messages go out in order. Must be called with
+# CONDITION held.
+def next_message():
+    now = time.time()
+    delay = None
+    seen = set()
+    rows = get_connection().execute(
+        'SELECT id, channel, params, enqueued FROM messages ORDER BY id'
+    )
+    for row in rows.fetchall():
+        channel = row[1]
+        if channel in seen or channel in in_flight:
+            seen.add(channel)
+            continue
+        seen.add(channel)
+        wait = max(blocked_until.get(channel, 0) - now, 0)
+        if not wait:
+            wait = take_token(channel, now)
+        if not wait:
+            return (row, None)
+        if delay is None or wait < delay:
+            delay = wait
+    return (None, delay)
+
+def send(row):
+    params = {**json.loads(row[2]), 'token': os.environ['BUILD_BOT_API_TOKEN']}
+    try:
+        response = http_client.SLACK.post(SLACK_API, data=params)
+    except Exception as error:
+        print('Error sending Slack message: ' + str(error))
+        return ERROR_DELAY
+    if response.status_code == 429:
+        return int(response.headers.get('Retry-After', ERROR_DELAY))
+    with CONDITION:
+        get_connection().execute('DELETE FROM messages WHERE id = ?', (row[0],))
+        get_connection().commit()
+        waits.append(time.time() - row[3])
+    return 0
+
+def worker():
+    while True:
+        with CONDITION:
+            row, delay = next_message()
+            if not row:
+                CONDITION.wait(min(delay or POLL_INTERVAL, POLL_INTERVAL))
+                continue
+            in_flight.add(row[1])
+        retry_after = send(row)
+        with CONDITION:
+            in_flight.discard(row[1])
+            if retry_after:
+                blocked_until[row[1]] = time.time() + retry_after
+            CONDITION.notify_all()
+
+# Start the sender threads. Messages left in the queue by a previous process
+# are sent too.
+def start():
+    with CONDITION:
+        while len(workers) < WORKERS:
+            thread = threading.Thread(target=worker, daemon=True)
+            thread.start()
+            workers.append(thread)
+
+def depth():
+    with CONDITION:
+        return get_connection().execute(
+            'SELECT COUNT(*) FROM messages'
+        ).fetchone()[0]
+
+# Block until every queued message has been sent. Used when a notifier runs on
+# its own instead of from clock.py.
+def drain():
+    start()
+    while depth():
+        time.sleep(0.1)
+
+# Print the queue depth, the age of the oldest queued message, and how long
+# messages sent since the last report waited in the queue:
+def report():
+    global waits
+    with CONDITION:
+        pending, oldest = get_connection().execute(
+            'SELECT COUNT(*), MIN(enqueued) FROM messages'
+        ).fetchone()
+        sent = waits
+        waits = []
+    message = 'Slack queue: {} pending'.format(pending)
+    if oldest:
+        message += ', oldest {:.1f}s'.format(time.time() - oldest)
+    if sent:
+        message += ', {} sent, average wait {:.1f}s, max wait {:.1f}s'.format(
+            len(sent),
+            sum(sent) / len(sent),
+            max(sent)
+        )
+    print(message)
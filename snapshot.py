@@ -0,0 +1,134 @@
+# Warm-start snapshot of the state that's otherwise only kept in memory: the
+# GitHub cursors, the parsed mapping, subscriptions and pull request indexes,
+# and the Jenkins watermarks and recent builds. The snapshot is one versioned
+# value in state_store, made of named sections, each of which is written by a
+# function like jenkins_slack_notifications.dump_state and read back by the
+# matching load_state. Every section written by one checkpoint is committed
+# together.
+#
+# Heroku wipes state.db when a dyno restarts, so the snapshot is also
+# published to the slack-mapping repo, along with the tracked notifications
+# and the most recently used cached responses (with their ETags). A process
+# that finds no snapshot in the database restores all of them from there.
+import json
+import os
+import tempfile
+import time
+import http_client
+import push_to_github
+import response_cache
+import state_store
+import track_notifications
+from base64 import b64decode
+
+# global constants:
+KEY = 'snapshot'
+# Change this whenever the format of any section changes. Snapshots of other
+# versions are ignored, so the next cycle starts cold instead of misreading
+# them.
+VERSION = 3
+# The published copy in the slack-mapping repo:
+FILENAME = 'snapshot.json'
+SNAPSHOT_URL = 'https://api.github.com/'\
+    'repos/'\
+    'TeachersPayTeachers/'\
+    'slack-mapping/'\
+    'contents/' + FILENAME
+# Seconds between publishes while nothing is being notified:
+PUBLISH_INTERVAL = int(os.environ.get('SNAPSHOT_PUBLISH_INTERVAL', 900))
+# Total size of the response bodies published, which keeps the file well under
+# the 1 MB the contents API will return:
+RESPONSE_BYTES = 512 * 1024
+# Key of the time of the last publish in state_store, shared by every process:
+PUBLISHED = 'snapshot.published'
+
+# global variables:
+# Names of the sections already restored in this process:
+restored = set()
+
+# Restore sections from the last snapshot, the first time each is asked for in
+# this process. loaders is a dict of section name to a load_state function.
+def restore(loaders):
+    global restored
+    names = [name for name in loaders if name not in restored]
+    if not names:
+        return
+    restored.update(names)
+    snapshot = state_store.load(KEY, {})
+    if snapshot.get('version') != VERSION:
+        snapshot = download()
+    if snapshot.get('version') != VERSION:
+        return
+    for name in names:
+        if name in snapshot['sections']:
+            loaders[name](snapshot['sections'][name])
+
+# Save sections, a dict of section name to the output of a dump_state function,
+# replacing those sections of the snapshot. Other sections, such as those of a
+# job running in another process, are kept.
+def checkpoint(sections):
+    def merge(snapshot):
+        if snapshot.get('version') != VERSION:
+            snapshot = {'version': VERSION, 'sections': {}}
+        snapshot['sections'].update(sections)
+        return snapshot
+    state_store.update(KEY, merge, {})
+
+# Import the published snapshot into the database and return it, or return {}
+# if there isn't one. Importing only adds what's missing, so processes that
+# start at the same time may each do it.
+def download():
+    global SNAPSHOT_URL
+    response = http_client.GITHUB.get(SNAPSHOT_URL)
+    if response.status_code >= 300:
+        return {}
+    try:
+        published = json.loads(b64decode(response.json()['content']).decode())
+    except (KeyError, ValueError) as error:
+        print('Error reading published snapshot: ' + repr(error))
+        return {}
+    if published.get('version') != VERSION:
+        return {}
+    track_notifications.load_state(published['notifications'])
+    response_cache.load_state(published['responses'])
+    # Keep a snapshot that another process has checkpointed in the meantime:
+    def merge(snapshot):
+        if snapshot.get('version') == VERSION:
+            return snapshot
+        return {'version': VERSION, 'sections': published['sections']}
+    return state_store.update(KEY, merge, {})
+
+# Publish the snapshot after a cycle: straight away if the cycle notified
+# anything, so that a restarted process doesn't notify about it again, and
+# otherwise every PUBLISH_INTERVAL seconds. A failed publish is tried again
+# after the next cycle.
+def publish(notified):
+    global PUBLISH_INTERVAL, RESPONSE_BYTES, FILENAME, SNAPSHOT_URL
+    now = time.time()
+    # Claim this publish, so that jobs in other processes don't repeat it:
+    def claim(published):
+        if notified or now - published >= PUBLISH_INTERVAL:
+            return now
+        return published
+    if state_store.update(PUBLISHED, claim, 0) != now:
+        return
+    snapshot = state_store.load(KEY, {})
+    if snapshot.get('version') != VERSION:
+        return
+    snapshot['notifications'] = track_notifications.dump_state()
+    # The published snapshot is cached too, once it's been fetched; it's left
+    # out so that it isn't nested in the next one:
+    snapshot['responses'] = response_cache.dump_state(
+        RESPONSE_BYTES,
+        SNAPSHOT_URL
+    )
+    # Jobs in other processes may be writing the file at the same time:
+    descriptor, filename = tempfile.mkstemp(dir='.')
+    with open(descriptor, 'w') as outfile:
+        json.dump(snapshot, outfile)
+    os.replace(filename, FILENAME)
+    try:
+        push_to_github.main(FILENAME, 'Updated snapshot.')
+    except Exception as error:
+        print('Error publishing snapshot: ' + repr(error))
+        state_store.save(PUBLISHED, 0)
@@ -0,0 +1,93 @@
+# The local store shared by every process: one SQLite database holding the
+# notification tracking, Slack queue and response cache tables, and a state
+# table of small JSON values such as cursors and user profiles. Each module
+# opens its own connection with connect(). Read-modify-write changes should be
+# made inside transaction(), which takes the database's write lock first, so
+# that jobs running in separate processes never lose each other's updates.
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# global constants:
+# Path of the database. It only helps a restarted process if it's somewhere
+# that survives the restart: Heroku wipes a dyno's filesystem whenever the dyno
+# restarts, so there state.db only lasts until then.
+DATABASE = os.environ.get('STATE_DATABASE', 'state.db')
+# Seconds to wait for another process to finish writing:
+BUSY_TIMEOUT = 30
+LOCK = threading.Lock()
+
+# global variables:
+connection = None
+
+# Open a new connection to the database. Write-ahead logging lets processes
+# read while another one writes.
+def connect():
+    new_connection = sqlite3.connect(
+        DATABASE,
+        timeout=BUSY_TIMEOUT,
+        check_same_thread=False
+    )
+    new_connection.execute('PRAGMA journal_mode=WAL')
+    return new_connection
+
+def get_connection():
+    global connection
+    if not connection:
+        connection = connect()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS state ('
+            'key TEXT PRIMARY KEY, '
+            'value TEXT NOT NULL)'
+        )
+        connection.commit()
+    return connection
+
+# Run the body of a with statement as one transaction on a connection, holding
+# the write lock from the start. It's committed if the body succeeds and rolled
+# back if it raises.
+@contextmanager
+def transaction(connection):
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+    except BaseException:
+        connection.rollback()
+        raise
+    connection.commit()
+
+def read(connection, key, default):
+    row = connection.execute(
+        'SELECT value FROM state WHERE key = ?',
+        (key,)
+    ).fetchone()
+    if row:
+        return json.loads(row[0])
+    return default
+
+def write(connection, key, value):
+    connection.execute(
+        'INSERT OR REPLACE INTO state VALUES (?, ?)',
+        (key, json.dumps(value))
+    )
+
+# Return the value saved under key, or default if there isn't one:
+def load(key, default=None):
+    with LOCK:
+        return read(get_connection(), key, default)
+
+def save(key, value):
+    with LOCK:
+        with transaction(get_connection()):
+            write(get_connection(), key, value)
+
+# Replace the value saved under key with function(value) in one transaction,
+# and return the new value. function is given default if nothing is saved.
+def update(key, function, default=None):
+    with LOCK:
+        with transaction(get_connection()):
+            value = function(read(get_connection(), key, default))
+            write(get_connection(), key, value)
+    return value
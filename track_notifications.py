@@ -1,5 +1,19 @@
 import json
 import os
+import threading
+import state_store
+
+# global constants:
+LOCK = threading.Lock()
+
+# global variables:
+connection = None
+# Names of old JSON tracking files that have already been imported:
+imported = set()
+# Dict of (filename, number) to timestamp for notifications tracked since the
+# last commit. They're kept out of the database until then so that the
+# database isn't locked against other processes for a whole cycle.
+pending = {}
 
 def get_dict(filename):
     if os.path.isfile(filename):
@@ -7,27 +21,101 @@ def get_dict(filename):
             return json.load(infile)
     return {}
 
-# timestamp should be a Unix timestamp in milliseconds.
-def track(number, timestamp, filename):
+# Open the database on first use. Numbers are stored as strings so that
+# pull ids (ints) and commit shas (strings) share a table. The timestamp index
+# lets clean() expire entries without touching the rest of the table.
+def get_connection():
+    global connection
+    if not connection:
+        connection = state_store.connect()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS notifications ('
+            'filename TEXT NOT NULL, '
+            'number TEXT NOT NULL, '
+            'timestamp REAL NOT NULL, '
+            'PRIMARY KEY (filename, number))'
+        )
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS notifications_timestamp '
+            'ON notifications (filename, timestamp)'
+        )
+        connection.commit()
+    return connection
+
+# Import a JSON tracking file left over from before the database existed, so
+# that nothing is notified twice after an upgrade:
+def import_file(filename):
+    if filename in imported:
+        return
+    imported.add(filename)
     numbers = get_dict(filename)
-    numbers[number] = timestamp
-    with open(filename, 'w') as outfile:
-        json.dump(numbers, outfile)
+    if not numbers:
+        return
+    with state_store.transaction(get_connection()):
+        get_connection().executemany(
+            'INSERT OR IGNORE INTO notifications VALUES (?, ?, ?)',
+            [(filename, str(number), numbers[number]) for number in numbers]
+        )
+    os.rename(filename, filename + '.imported')
+
+# timestamp should be a Unix timestamp in milliseconds. Notifications are not
+# written to disk until commit() or clean() is called, so a whole cycle is
+# written at once.
+def track(number, timestamp, filename):
+    with LOCK:
+        pending[(filename, str(number))] = timestamp
 
 def already_notified(number, filename):
-    numbers = get_dict(filename)
-    return number in numbers or str(number) in numbers
+    with LOCK:
+        if (filename, str(number)) in pending:
+            return True
+        import_file(filename)
+        row = get_connection().execute(
+            'SELECT 1 FROM notifications WHERE filename = ? AND number = ?',
+            (filename, str(number))
+        ).fetchone()
+    return row is not None
+
+# Write pending notifications. Must be called with LOCK held and a transaction
+# open.
+def write_pending():
+    global pending
+    get_connection().executemany(
+        'INSERT OR REPLACE INTO notifications VALUES (?, ?, ?)',
+        [key + (pending[key],) for key in pending]
+    )
+    pending = {}
+
+def commit():
+    with LOCK:
+        with state_store.transaction(get_connection()):
+            write_pending()
 
 # current_time should be a Unix timestamp in milliseconds. max_age should also
 # be in milliseconds.
 def clean(current_time, max_age, filename):
-    numbers = get_dict(filename)
-    old_numbers = []
-    for number in numbers:
-        # numbers[number] refers to the timestamp of the number in the dict.
-        if current_time - numbers[number] > max_age:
-            old_numbers.append(number)
-    for number in old_numbers:
-        del numbers[number]
-    with open(filename, 'w') as outfile:
-        json.dump(numbers, outfile)
+    with LOCK:
+        import_file(filename)
+        with state_store.transaction(get_connection()):
+            write_pending()
+            get_connection().execute(
+                'DELETE FROM notifications WHERE filename = ? AND timestamp < ?',
+                (filename, current_time - max_age)
+            )
+
+# Return every tracked notification as [filename, number, timestamp] lists for
+# snapshot:
+def dump_state():
+    with LOCK:
+        return [list(row) for row in get_connection().execute(
+            'SELECT filename, number, timestamp FROM notifications'
+        )]
+
+# Track the notifications from dump_state that aren't tracked already:
+def load_state(state):
+    with LOCK:
+        with state_store.transaction(get_connection()):
+            get_connection().executemany(
+                'INSERT OR IGNORE INTO notifications VALUES (?, ?, ?)',
+                state
+            )
@@ -0,0 +1,82 @@
+# Cache of GitHub user profiles (name and email) keyed by login. Profiles are
+# served from memory for TTL seconds, then revalidated with their ETag. The
+# least recently used profiles are evicted past MAX_SIZE, and the cache is saved
+# to the state_store database so it survives between cycles and restarts and is
+# shared with other processes.
+import threading
+import time
+import http_client
+import state_store
+from collections import OrderedDict
+
+# global constants:
+KEY = 'user_profiles'
+TTL = 24 * 60 * 60 #seconds
+MAX_SIZE = 1000
+LOCK = threading.Lock()
+
+# global variables:
+profiles = None
+
+def load():
+    global profiles
+    profiles = OrderedDict()
+    profiles.update(state_store.load(KEY, {}))
+
+# Merge our profiles into the saved ones, keeping whichever of each was fetched
+# last, so that processes saving at the same time don't undo each other:
+def merge(saved):
+    for login in profiles:
+        if (login not in saved or
+            saved[login]['fetched'] < profiles[login]['fetched']):
+            saved[login] = profiles[login]
+    logins = sorted(saved, key=lambda login: saved[login]['fetched'])
+    for login in logins[:max(len(saved) - MAX_SIZE, 0)]:
+        del saved[login]
+    return saved
+
+def save():
+    with LOCK:
+        if profiles is not None:
+            saved = state_store.update(KEY, merge, {})
+            for login in saved:
+                if login not in profiles:
+                    profiles[login] = saved[login]
+
+# Return {'name': ..., 'email': ...} for a GitHub login:
+def get(login):
+    with LOCK:
+        if profiles is None:
+            load()
+        entry = profiles.get(login)
+        if entry and time.time() - entry['fetched'] < TTL:
+            profiles.move_to_end(login)
+            return entry
+    headers = {}
+    if entry:
+        headers['If-None-Match'] = entry['etag']
+    response = http_client.GITHUB.get(
+        'https://api.github.com/users/' + login,
+        headers=headers
+    )
+    if response.status_code == 304:
+        entry = {**entry, 'fetched': time.time()}
+    elif response.status_code < 300:
+        user_data = response.json()
+        entry = {
+            'name': user_data['name'],
+            'email': user_data['email'],
+            'etag': response.headers.get('Etag', ''),
+            'fetched': time.time()
+        }
+    elif entry:
+        # Serve the stale profile rather than nothing if GitHub is failing:
+        return entry
+    else:
+        return {'name': None, 'email': None}
+    with LOCK:
+        profiles[login] = entry
+        profiles.move_to_end(login)
+        while len(profiles) > MAX_SIZE:
+            profiles.popitem(last=False)
+    return entry
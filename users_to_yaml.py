@@ -1,39 +1,74 @@
 # Script to get list of users from Slack API and write to YAML:
 import os
 import json
-import requests
+import time
+import http_client
 from yaml import dump
 
+# global constants:
+PAGE_SIZE = 200
+# Times to retry a page when Slack rate limits us:
+MAX_RETRIES = 5
+RETRY_DELAY = 30 #seconds to wait if Slack doesn't send Retry-After
+
 def get_member_data(members):
-    member_data = []
     for member in members:
         if not member.get('is_bot') and not member.get('is_restricted'):
             member_concise = {
                 'id': member['id'],
                 'name': member['name'],
-                'email': member['profile']['email'],
-                'real_name': member['profile']['real_name']
+                'email': member['profile'].get('email'),
+                'real_name': member['profile'].get('real_name'),
+                'deleted': member.get('deleted', False)
             }
-            member_data.append(member_concise)
-    return member_data
+            yield member_concise
+
+# Get one page of users.list, waiting as long as Slack's Retry-After asks when
+# we're rate limited. Any other error is raised, so that make_mapping doesn't
+# act on a partial list of members.
+def get_page(url, params):
+    for attempt in range(MAX_RETRIES + 1):
+        response = http_client.SLACK.get(url, params=params)
+        if response.status_code == 429:
+            time.sleep(int(response.headers.get('Retry-After', RETRY_DELAY)))
+            continue
+        if response.status_code >= 300:
+            raise RuntimeError(
+                'users.list failed with status ' + str(response.status_code)
+            )
+        page = response.json()
+        if not page.get('ok'):
+            raise RuntimeError('users.list failed: ' + str(page.get('error')))
+        return page
+    raise RuntimeError('users.list is still rate limited')
 
+# Yield every member of the Slack team, one page of users.list at a time:
 def get_members_from_api():
     url='https://slack.com/api/users.list'
     token = os.environ['BUILD_BOT_API_TOKEN']
-    return requests.get(url, params={'token': token}).json()['members']
+    params = {'token': token, 'limit': PAGE_SIZE}
+    while True:
+        response = get_page(url, params)
+        for member in response['members']:
+            yield member
+        cursor = response.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            break
+        params['cursor'] = cursor
 
 def main():
     members = get_members_from_api()
-    member_data = get_member_data(members)
-    to_yaml = {}
-    for member in member_data:
-        to_yaml[str(member['name'])] = {
-            'id': str(member['id']),
-            'email': str(member['email']),
-            'real_name': str(member['real_name'])
-        }
+    # Each member is written as it arrives; the dumped entries together form
+    # one YAML mapping.
     with open('user_mapping.yaml', 'w') as outfile:
-        dump(to_yaml, outfile, width=1000)
+        for member in get_member_data(members):
+            if member['deleted']:
+                continue
+            dump({str(member['name']): {
+                'id': str(member['id']),
+                'email': str(member['email']),
+                'real_name': str(member['real_name'])
+            }}, outfile, width=1000)
 
 if __name__ == '__main__':
     main()
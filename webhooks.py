@@ -0,0 +1,194 @@
+# Web process that receives GitHub webhooks and Jenkins notification plugin
+# callbacks and notifies about them right away, instead of waiting for
+# clock.py to poll. Polling still runs here, less often, to catch anything a
+# webhook missed.
+#
+# GitHub webhooks (push, pull_request and issue_comment) should be sent to
+# /github, signed with GITHUB_WEBHOOK_SECRET. The Jenkins notification plugin
+# should send JSON to /jenkins?token=<JENKINS_WEBHOOK_TOKEN>.
+import os
+import hmac
+import hashlib
+import json
+import threading
+import datetime
+import jenkins_slack_notifications
+import github_slack_notifications
+import slack_queue
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from apscheduler.schedulers.background import BackgroundScheduler
+
+# global constants:
+# Seconds between polls that catch anything webhooks missed. A GitHub poll
+# looks back to the start of the one before it, up to MAX_LOOKBACK, and a
+# Jenkins poll sees builds up to MAX_AGE old, so the intervals are kept within
+# those:
+GITHUB_RECONCILE = min(
+    int(os.environ.get('GITHUB_RECONCILE', 600)),
+    github_slack_notifications.MAX_LOOKBACK
+)
+JENKINS_RECONCILE = min(
+    int(os.environ.get('JENKINS_RECONCILE', 300)),
+    # Half of MAX_AGE, which is in milliseconds:
+    jenkins_slack_notifications.MAX_AGE // 2000
+)
+# Webhook event names and the org events feed types they correspond to:
+EVENT_TYPES = {
+    'push': 'PushEvent',
+    'pull_request': 'PullRequestEvent',
+    'issue_comment': 'IssueCommentEvent'
+}
+# Each source is handled by one thread at a time, since the notifier modules
+# keep their state in globals:
+GITHUB_LOCK = threading.Lock()
+JENKINS_LOCK = threading.Lock()
+EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+# Return True if a GitHub webhook body was signed with our secret:
+def valid_signature(body, headers, secret):
+    if 'X-Hub-Signature-256' in headers:
+        algorithm = hashlib.sha256
+        signature = headers['X-Hub-Signature-256']
+    elif 'X-Hub-Signature' in headers:
+        algorithm = hashlib.sha1
+        signature = headers['X-Hub-Signature']
+    else:
+        return False
+    digest = hmac.new(secret.encode(), body, algorithm).hexdigest()
+    expected = signature.split('=', 1)[0] + '=' + digest
+    return hmac.compare_digest(expected, signature)
+
+# Convert a GitHub webhook payload to the format of the org events feed, which
+# github_slack_notifications already knows how to read:
+def to_event(event_name, payload):
+    event = {
+        'type': EVENT_TYPES[event_name],
+        'repo': {'name': payload['repository']['full_name']},
+        'actor': {'login': payload['sender']['login']},
+        'created_at': datetime.datetime.utcnow().strftime(
+            '%Y-%m-%dT%H:%M:%SZ'
+        ),
+        'payload': payload
+    }
+    if event_name == 'push':
+        # Push webhooks call a commit's sha its id:
+        event['payload'] = {
+            'ref': payload['ref'],
+            'commits': [
+                {'sha': commit['id'], 'author': commit['author']}
+                for commit in payload['commits']
+            ]
+        }
+    return event
+
+def handle_github(event):
+    with GITHUB_LOCK:
+        github_slack_notifications.handle_events([event])
+
+def handle_jenkins(url):
+    with JENKINS_LOCK:
+        jenkins_slack_notifications.handle_build(url)
+
+def reconcile_github():
+    with GITHUB_LOCK:
+        github_slack_notifications.main()
+
+def reconcile_jenkins():
+    with JENKINS_LOCK:
+        jenkins_slack_notifications.main()
+
+# Log errors from handlers running on EXECUTOR, which would otherwise be lost:
+def log_errors(future):
+    if future.exception():
+        print('Error handling webhook: ' + repr(future.exception()))
+
+# Webhooks can be sent as JSON or, if the webhook was set up with the
+# application/x-www-form-urlencoded content type, as JSON in a payload field.
+# The signature covers the body as sent either way.
+def get_payload(body, headers):
+    if headers.get('Content-Type', '').startswith(
+        'application/x-www-form-urlencoded'):
+        return json.loads(parse_qs(body.decode())['payload'][0])
+    return json.loads(body.decode())
+
+class Handler(BaseHTTPRequestHandler):
+
+    def respond(self, status):
+        self.send_response(status)
+        self.end_headers()
+
+    def do_POST(self):
+        path = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if path.path == '/github':
+            self.github(body)
+        elif path.path == '/jenkins':
+            self.jenkins(body, parse_qs(path.query))
+        else:
+            self.respond(404)
+
+    def github(self, body):
+        secret = os.environ['GITHUB_WEBHOOK_SECRET']
+        if not valid_signature(body, self.headers, secret):
+            return self.respond(401)
+        event_name = self.headers.get('X-GitHub-Event')
+        if event_name not in EVENT_TYPES:
+            # Includes the ping GitHub sends when a webhook is created:
+            return self.respond(204)
+        event = to_event(event_name, get_payload(body, self.headers))
+        # Reply right away; GitHub gives up on webhooks after 10 seconds.
+        EXECUTOR.submit(handle_github, event).add_done_callback(log_errors)
+        self.respond(202)
+
+    def jenkins(self, body, query):
+        token = os.environ['JENKINS_WEBHOOK_TOKEN']
+        if not hmac.compare_digest(query.get('token', [''])[0], token):
+            return self.respond(401)
+        build = json.loads(body.decode())['build']
+        # The plugin also reports when builds are queued and started:
+        if build.get('phase') not in ['COMPLETED', 'FINALIZED']:
+            return self.respond(204)
+        url = build['full_url']
+        EXECUTOR.submit(handle_jenkins, url).add_done_callback(log_errors)
+        self.respond(202)
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+# Return a server listening on port. Use port 0 to pick a free port, which
+# is then available as server.server_address[1].
+def make_server(port):
+    return Server(('', port), Handler)
+
+def main():
+    # handle_jenkins only adds the builds it's told about, so polling must be
+    # incremental to keep the other recent builds around for all_tests_passed:
+    jenkins_slack_notifications.JENKINS_INCREMENTAL = True
+    slack_queue.start()
+    scheduler = BackgroundScheduler()
+    # Poll once at startup, then every *_RECONCILE seconds:
+    now = datetime.datetime.now()
+    scheduler.add_job(
+        reconcile_jenkins,
+        'interval',
+        seconds=JENKINS_RECONCILE,
+        next_run_time=now
+    )
+    scheduler.add_job(
+        reconcile_github,
+        'interval',
+        seconds=GITHUB_RECONCILE,
+        next_run_time=now
+    )
+    scheduler.start()
+    server = make_server(int(os.environ.get('PORT', 5000)))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+if __name__ == '__main__':
+    main()